@@ -0,0 +1,113 @@
+import io
+import wave
+import logging
+import subprocess
+from typing import Union
+from vad import trim_silence, normalize_loudness
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+# Speech recognition input format: 16kHz, mono, 16-bit PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+
+def run_ffmpeg(source: Union[str, bytes], output_args: list) -> bytes:
+    """Runs ffmpeg with in-memory output.
+
+    source is either a path to an existing file or the audio itself, which
+    is piped to ffmpeg's stdin. The result is read from ffmpeg's stdout, so
+    no intermediate files are written.
+    """
+    input_arg = 'pipe:0' if isinstance(source, (bytes, bytearray)) else source
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', input_arg, *output_args, 'pipe:1']
+    result = subprocess.run(
+        cmd,
+        input=source if input_arg == 'pipe:0' else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+    return result.stdout
+
+
+def convert_audio_to_pcm(source: Union[str, bytes], sample_rate: int = SAMPLE_RATE) -> bytes:
+    """Decodes audio to raw 16-bit little-endian mono PCM."""
+    return run_ffmpeg(source, ['-ac', '1', '-ar', str(sample_rate), '-acodec', 'pcm_s16le', '-f', 's16le'])
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """Wraps raw 16-bit mono PCM into a WAV container."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(SAMPLE_WIDTH)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def convert_audio_to_wav(source: Union[str, bytes]) -> bytes:
+    """
+    Convert audio to WAV format with 16kHz sample rate, mono channel, and 16-bit depth.
+    Returns the WAV file content.
+    """
+    return pcm_to_wav(convert_audio_to_pcm(source))
+
+
+def encode_ogg_opus(source: Union[str, bytes]) -> bytes:
+    """Encodes audio as OGG with OPUS codec, the format of Telegram voice messages."""
+    return run_ffmpeg(source, ['-c:a', 'libopus', '-strict', '-2', '-f', 'ogg'])
+
+
+def concat_speech(wavs: list, gap: float = 0.25) -> bytes:
+    """Joins WAV segments in order, with gap seconds of silence between them.
+
+    Segments of the same PCM format are joined as they are; otherwise all of
+    them are converted to 16-bit mono PCM at the first segment's rate.
+    Returns the WAV audio.
+    """
+    try:
+        params = []
+        frames = []
+        for wav in wavs:
+            with wave.open(io.BytesIO(wav), 'rb') as wav_file:
+                params.append((wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate()))
+                frames.append(wav_file.readframes(wav_file.getnframes()))
+    except (wave.Error, EOFError):
+        # Not plain PCM, e.g. float samples
+        params = []
+    if params and len(set(params)) == 1:
+        channels, sample_width, sample_rate = params[0]
+    else:
+        sample_rate = params[0][2] if params else 24000
+        channels, sample_width = 1, SAMPLE_WIDTH
+        frames = [convert_audio_to_pcm(wav, sample_rate) for wav in wavs]
+    silence = b'\x00' * (int(gap * sample_rate) * channels * sample_width)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(silence.join(frames))
+    return buffer.getvalue()
+
+
+def prepare_reference(source: Union[str, bytes], max_duration: float = 12.0, target_db: float = -20.0) -> bytes:
+    """Turns an uploaded recording into a TTS reference voice.
+
+    Leading and trailing silence is trimmed, the speech is capped to
+    max_duration seconds and normalized to target_db RMS. Returns the WAV
+    audio, or empty bytes if the recording contains no speech.
+    """
+    pcm = trim_silence(convert_audio_to_pcm(source), SAMPLE_RATE)
+    max_bytes = int(max_duration * SAMPLE_RATE) * SAMPLE_WIDTH
+    if len(pcm) > max_bytes:
+        # Don't end the reference on a cut-off word's tail of silence
+        pcm = trim_silence(pcm[:max_bytes], SAMPLE_RATE)
+    if not pcm:
+        return b''
+    return pcm_to_wav(normalize_loudness(pcm, target_db))
@@ -0,0 +1,231 @@
+"""Offline micro-benchmarks of the bot's hot paths.
+
+Runs without Telegram, OpenAI, Google or the TTS server: the server module
+is imported in a temporary working directory with a dummy config.json, and
+all audio is generated with ffmpeg.
+
+Usage:
+    python benchmarks/bench_hot_paths.py [--output results.json] [--compare baseline.json]
+
+Results are written as JSON (by default to benchmarks/results/<commit>.json),
+so runs of different commits can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+HISTORY_SIZES = [10, 100, 1000, 10000]  # Turns per synthetic user
+AUDIO_DURATIONS = [5, 30, 120]  # Seconds
+AUDIO_CODECS = {
+    'opus': ['-c:a', 'libopus', '-f', 'ogg'],
+    'mp3': ['-c:a', 'libmp3lame', '-f', 'mp3'],
+    'wav': ['-c:a', 'pcm_s16le', '-ar', '44100', '-f', 'wav'],
+}
+
+
+def measure(func, min_runs=5, max_runs=1000, budget=2.0) -> dict:
+    """Calls func repeatedly, for at least min_runs and at most budget
+    seconds, and returns timing statistics in milliseconds."""
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs:
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+        if len(samples) >= min_runs and time.perf_counter() - started > budget:
+            break
+    samples.sort()
+    return {
+        'runs': len(samples),
+        'mean_ms': round(statistics.mean(samples), 4),
+        'median_ms': round(statistics.median(samples), 4),
+        'p95_ms': round(samples[min(int(len(samples) * 0.95), len(samples) - 1)], 4),
+        'min_ms': round(samples[0], 4),
+    }
+
+
+def generate_audio(duration: int, output_args: list) -> bytes:
+    """Synthetic speech-like test signal: a tone with a varying pitch and noise."""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"sine=frequency=220:duration={duration}:sample_rate=48000",
+        '-f', 'lavfi', '-i', f"anoisesrc=duration={duration}:amplitude=0.02:sample_rate=48000",
+        '-filter_complex', 'amix=inputs=2,vibrato=f=5:d=0.5',
+        '-ac', '1', *output_args, 'pipe:1'
+    ]
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
+
+
+def setup_workdir() -> str:
+    """Creates a working directory the server module can be imported from."""
+    workdir = tempfile.mkdtemp(prefix='voclone_bench_')
+    config = {
+        'TOKEN': '1:benchmark',
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'LANGSMITH_API_KEY': 'benchmark',
+        'LANGSMITH_PROJECT': 'benchmark',
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    for name in ['BCP-47.txt', 'greeting.txt', 'mentagram.json']:
+        shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    os.chdir(workdir)
+    return workdir
+
+
+def fill_history(server, user_id: str, turns: int) -> None:
+    store = server.get_history_store(user_id)
+    for i in range(turns // 2):
+        store.append(
+            [("user", f"Question {i} about the weather, music and plans for the weekend?"),
+             ("assistant", f"Answer {i}: it will be sunny, so a walk in the park sounds like a good plan.")],
+            message_id=str(i)
+        )
+
+
+def bench_history(server) -> dict:
+    results = {}
+    prompt = server.get_user_prompt('bench')
+    for size in HISTORY_SIZES:
+        user_id = f'history_{size}'
+        fill_history(server, user_id, size)
+
+        def cold_read():
+            server.user_cache.invalidate(user_id)
+            server.get_chat_history(user_id, prompt, "What should I do today?")
+
+        def warm_read():
+            server.get_chat_history(user_id, prompt, "What should I do today?")
+
+        def append():
+            server.manage_chat_history(user_id, 'bench', {"user": "Hello!", "assistant": "Hi, how are you?"})
+
+        results[f'get_chat_history_cold/{size}'] = measure(cold_read)
+        results[f'get_chat_history_warm/{size}'] = measure(warm_read)
+        results[f'manage_chat_history/{size}'] = measure(append)
+    # Drop summarization tasks scheduled by budget overflows, there is no LLM
+    for task in server.summary_tasks.values():
+        task.cancel()
+    return results
+
+
+def bench_audio(server) -> dict:
+    from audio_tools import convert_audio_to_wav, encode_ogg_opus
+    results = {}
+    for duration in AUDIO_DURATIONS:
+        for codec, output_args in AUDIO_CODECS.items():
+            audio = generate_audio(duration, output_args)
+            results[f'convert_audio_to_wav/{codec}/{duration}s'] = measure(
+                lambda: convert_audio_to_wav(audio), min_runs=3, budget=3.0
+            )
+        # The synthesized speech sent with send_voice_message
+        speech = generate_audio(duration, ['-c:a', 'pcm_s16le', '-ar', '24000', '-f', 'wav'])
+        results[f'encode_ogg_opus/{duration}s'] = measure(
+            lambda: encode_ogg_opus(speech), min_runs=3, budget=3.0
+        )
+    return results
+
+
+def bench_prompt(server) -> dict:
+    results = {}
+    with open('mentagram.json', 'r', encoding='utf-8') as f:
+        mentagram = json.load(f)
+    fill_history(server, 'prompt_default', 200)
+    fill_history(server, 'prompt_mentagram', 200)
+    server.save_user_init_data('prompt_mentagram', mentagram)
+    for user_id in ['prompt_default', 'prompt_mentagram']:
+        results[f'build_prompt/{user_id}'] = measure(
+            lambda: server.build_prompt(user_id, "Tell me about the stars tonight.", 'en')
+        )
+    results['compile_prompt/mentagram'] = measure(
+        lambda: server.compile_prompt(mentagram, server.DEFAULT_SYSTEM_PROMPT, server.token_counter)
+    )
+    for task in server.summary_tasks.values():
+        task.cancel()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    """Prints the median change of every benchmark against a previous run."""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['benchmarks']
+    print(f"\n{'benchmark':60} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median_ms']
+        after = stats['median_ms']
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:60} {before:10.3f} {after:10.3f} {change:+7.1f}%")
+
+
+async def run(selected: list) -> dict:
+    import server
+    benchmarks = {'history': bench_history, 'audio': bench_audio, 'prompt': bench_prompt}
+    results = {}
+    for name in selected:
+        print(f"Running {name} benchmarks...")
+        results.update(benchmarks[name](server))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='Result file, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', help='Previous result file to compare against')
+    parser.add_argument('--only', nargs='+', choices=['history', 'audio', 'prompt'],
+                        default=['history', 'audio', 'prompt'], help='Benchmark groups to run')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(REPO_DIR, 'benchmarks', 'results', f'{commit}.json'))
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = setup_workdir()
+    try:
+        results = asyncio.run(run(args.only))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in results.items():
+        print(f"{name:60} median {stats['median_ms']:10.3f} ms  p95 {stats['p95_ms']:10.3f} ms")
+    print(f"Results saved to {output}")
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
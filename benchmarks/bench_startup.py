@@ -0,0 +1,195 @@
+"""Cold start of the bot: import times, time to readiness and first use of each subsystem.
+
+Runs without Telegram, OpenAI, Google or the TTS server, in a temporary
+working directory with a dummy config.json, like bench_hot_paths.py. Three
+measurements, each in fresh interpreters so nothing is cached in memory:
+
+- imports: the median time to import each heavy dependency and the server
+  module itself, over --runs interpreters;
+- ready: uvicorn is started with the server app and GET /test is polled,
+  giving the time until the server answers after a container restart; then
+  /warmup_stats is polled until the background pre-warm has finished;
+- first use: the server module is imported and every lazily initialized
+  subsystem is called twice, the first call paying for its initialization.
+  The STT client fails without Google credentials, which is reported.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'loadtest'))
+
+from bench_hot_paths import setup_workdir
+
+# Heavy dependencies, then the server module with its own ones
+MODULES = [
+    'fastapi',
+    'aiohttp',
+    'telebot.async_telebot',
+    'numpy',
+    'prometheus_client',
+    'tiktoken',
+    'langchain_core.messages',
+    'langchain_openai',
+    'google.cloud.speech_v1',
+    'server',
+]
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+
+def child_env() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR, os.path.join(REPO_DIR, 'loadtest'), env.get('PYTHONPATH', '')])
+    return env
+
+
+def bench_imports(workdir: str, runs: int) -> dict:
+    results = {}
+    for module in MODULES:
+        samples = []
+        for _ in range(runs):
+            completed = subprocess.run(
+                [sys.executable, '-c', IMPORT_SNIPPET.format(module=module)], cwd=workdir, env=child_env(),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            if completed.returncode != 0:
+                results[module] = {'error': completed.stderr.decode().strip().splitlines()[-1]}
+                break
+            samples.append(float(completed.stdout.decode().strip().splitlines()[-1]) * 1000)
+        else:
+            results[module] = {'median_ms': round(statistics.median(samples), 1), 'max_ms': round(max(samples), 1)}
+        print(f"import {module:30} {results[module]}")
+    return results
+
+
+def get_json(url: str, timeout: float = 1.0):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def bench_ready(workdir: str, port: int, timeout: float) -> dict:
+    """Starts uvicorn and measures the time until /test answers and until pre-warm is done."""
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server:app', '--host', '127.0.0.1', '--port', str(port)],
+        cwd=workdir, env=child_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    result = {}
+    try:
+        while 'ready_ms' not in result:
+            if time.monotonic() - start > timeout or process.poll() is not None:
+                return {'error': 'server did not become ready'}
+            try:
+                get_json(f'http://127.0.0.1:{port}/test')
+                result['ready_ms'] = round((time.monotonic() - start) * 1000, 1)
+            except OSError:
+                time.sleep(0.01)
+        while time.monotonic() - start < timeout:
+            warmup = get_json(f'http://127.0.0.1:{port}/warmup_stats')
+            if warmup['done'] or not warmup['enabled']:
+                result['warm_ms'] = round((time.monotonic() - start) * 1000, 1)
+                result['warmup'] = warmup['subsystems']
+                break
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def bench_first_use(workdir: str) -> dict:
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--first-use-child'], cwd=workdir, env=child_env(),
+        stdout=subprocess.PIPE
+    )
+    results = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    for name, stats in results.items():
+        print(f"first use {name:27} {stats}")
+    return results
+
+
+async def first_use() -> dict:
+    """Calls every subsystem twice, in the process of a fresh server import."""
+    start = time.perf_counter()
+    import server
+    from audio_tools import pcm_to_wav, encode_ogg_opus
+    from stubs import StubTTSServer, start_site
+    results = {'import server': {'first_ms': round((time.perf_counter() - start) * 1000, 1)}}
+
+    tts_server = StubTTSServer(0.0)
+    runner = await start_site(tts_server.app(), 5066)
+    server.tts_client.backends[0].url = 'http://127.0.0.1:5066'
+    silence = pcm_to_wav(b'\0' * server.SAMPLE_RATE * server.SAMPLE_WIDTH)
+    subsystems = [
+        ('tokenizer', lambda: server.token_counter.count('Hello, world!')),
+        ('prompt', server.warm_prompt),
+        ('llm', server.get_llm),
+        ('stt', server.get_speech_client),
+        ('tts', lambda: server.tts_client.generate_speech('Hello.', 'en', 'asmr_0.wav')),
+        ('ffmpeg', lambda: server.run_audio_task(encode_ogg_opus, silence)),
+    ]
+    try:
+        for name, call in subsystems:
+            samples = []
+            try:
+                for _ in range(2):
+                    call_start = time.perf_counter()
+                    result = call()
+                    if asyncio.iscoroutine(result):
+                        await result
+                    samples.append(round((time.perf_counter() - call_start) * 1000, 1))
+                results[name] = {'first_ms': samples[0], 'second_ms': samples[1]}
+            except Exception as e:
+                results[name] = {'error': f"{type(e).__name__}: {e}".splitlines()[0]}
+    finally:
+        await server.tts_client.close()
+        await runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Interpreters started per imported module')
+    parser.add_argument('--port', type=int, default=5067, help='Port of the server started for the readiness check')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for readiness and pre-warm')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--first-use-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_use_child:
+        print(json.dumps(asyncio.run(first_use())))
+        return
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = setup_workdir()
+    os.chdir(REPO_DIR)
+    try:
+        results = {
+            'imports': bench_imports(workdir, args.runs),
+            'ready': bench_ready(workdir, args.port, args.timeout),
+            'first_use': bench_first_use(workdir),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"ready {results['ready']}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
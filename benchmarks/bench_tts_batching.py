@@ -0,0 +1,116 @@
+"""Latency and throughput of TTS micro-batching against a stub GPU server.
+
+Starts the stub TTS server of the load test in-process, with a single
+simulated GPU: calls are served one at a time, a /tts call takes --latency
+seconds and a /tts_batch call of n texts takes
+latency * (1 + batch-cost * (n - 1)). Requests arrive at --rate per second
+(Poisson) and go through TTSClient, once without batching and once for
+every batch window, so the queueing saved by batching can be weighed
+against the time requests wait for their batch to fill.
+
+Usage:
+    python benchmarks/bench_tts_batching.py [--rate 20] [--windows 0 0.01 0.05] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'loadtest'))
+
+from stubs import StubTTSServer, start_site
+from tts_tools import TTSClient
+from run_load import latency_summary
+
+
+async def run_config(args, window: float) -> dict:
+    """Replays the arrivals through a client with the given batch window, 0 for no batching."""
+    tts_server = StubTTSServer(args.latency, batch_cost=args.batch_cost, serial=True)
+    runner = await start_site(tts_server.app(), args.port)
+    client = TTSClient(
+        f'http://127.0.0.1:{args.port}',
+        timeout=args.timeout,
+        batch_window=window,
+        batch_max_size=args.max_size
+    )
+    latencies = []
+    errors = 0
+
+    async def request(i: int) -> None:
+        nonlocal errors
+        start = time.monotonic()
+        speech = await client.generate_speech(f'Sentence number {i}.', 'en', 'asmr_0.wav')
+        if speech is None:
+            errors += 1
+        else:
+            latencies.append(time.monotonic() - start)
+
+    rng = random.Random(args.seed)
+    tasks = []
+    start = time.monotonic()
+    try:
+        for i in range(args.requests):
+            tasks.append(asyncio.create_task(request(i)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        wall_time = time.monotonic() - start
+        stats = client.stats()
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return {
+        'window_s': window,
+        'completed': len(latencies),
+        'errors': errors,
+        'throughput_per_s': round(len(latencies) / wall_time, 2),
+        'latency': latency_summary(latencies),
+        'server_calls': tts_server.batches if window else tts_server.requests,
+        'batch_avg_size': stats.get('batch_avg_size', 1.0),
+        'batch_avg_wait_ms': round(stats.get('batch_avg_wait', 0.0) * 1000, 1)
+    }
+
+
+async def run(args) -> list:
+    results = []
+    for window in args.windows:
+        result = await run_config(args, window)
+        results.append(result)
+        latency = result['latency']
+        print(f"window {window * 1000:6.1f} ms: p50 {latency['p50_ms']:8.1f} ms, p95 {latency['p95_ms']:8.1f} ms, "
+              f"p99 {latency['p99_ms']:8.1f} ms, {result['throughput_per_s']:6.2f}/s, "
+              f"batch {result['batch_avg_size']:5.2f}, errors {result['errors']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Syntheses per configuration')
+    parser.add_argument('--rate', type=float, default=20.0, help='Mean arrivals per second')
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 0.005, 0.01, 0.025, 0.05, 0.1],
+                        help='Batch windows in seconds, 0 sends every text on its own')
+    parser.add_argument('--max-size', type=int, default=8, help='Most texts in a batch')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds of GPU time for one text')
+    parser.add_argument('--batch-cost', type=float, default=0.1, help='Extra GPU time of each further text in a batch, relative to one text')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Deadline of a TTS call')
+    parser.add_argument('--port', type=int, default=5065, help='Port of the stub TTS server')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the arrival times')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    for name in ['tts_tools', 'tts_backends', 'tts_batching']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
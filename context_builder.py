@@ -0,0 +1,152 @@
+import sys
+import logging
+import threading
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+# Tokens the chat format adds around every message and the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the summary with the new messages. Keep names, facts, preferences and open questions, "
+    "write in the language of the conversation and stay under {max_tokens} tokens. "
+    "Reply with the summary only."
+)
+
+LANGUAGE_HINT = "Please respond in {language} language."
+
+
+class TokenCounter:
+    """Counts prompt tokens with the model's local tokenizer.
+
+    The encoding is loaded on first use, so importing the server doesn't
+    wait for it. Falls back to a four-characters-per-token estimate if the
+    encoding can't be loaded (tiktoken downloads it on first use).
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.encoding = None
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Loads the encoding, if it isn't loaded yet."""
+        with self._lock:
+            if self.loaded:
+                return
+            try:
+                import tiktoken
+                try:
+                    self.encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                logger.warning(f"Tokenizer unavailable ({e}), estimating token counts")
+                self.encoding = None
+            self.loaded = True
+
+    def count(self, text: str) -> int:
+        if not self.loaded:
+            self.load()
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: List[Tuple[str, str]]) -> int:
+        """Counts the tokens of (role, content) messages, including the chat format overhead."""
+        return sum(MESSAGE_OVERHEAD + self.count(content) for _, content in messages) + REPLY_OVERHEAD
+
+
+def fit_records(records: List[List[Tuple[str, str]]], budget: int, counter: TokenCounter) -> int:
+    """Returns the index of the oldest record that still fits into budget
+    tokens together with all newer records."""
+    start = len(records)
+    used = 0
+    for record in reversed(records):
+        used += sum(MESSAGE_OVERHEAD + counter.count(content) for _, content in record)
+        if used > budget:
+            break
+        start -= 1
+    return start
+
+
+async def summarize(llm, summary: str, turns: List[Tuple[str, str]], counter: TokenCounter,
+                    max_tokens: int, input_tokens: int) -> str:
+    """Folds turns into the running summary.
+
+    The turns are sent in chunks of at most input_tokens, so any backlog
+    of old messages can be summarized.
+    """
+    chunk = []
+    used = 0
+    for role, content in turns:
+        size = MESSAGE_OVERHEAD + counter.count(content)
+        if chunk and used + size > input_tokens:
+            summary = await _summarize_chunk(llm, summary, chunk, max_tokens)
+            chunk, used = [], 0
+        chunk.append((role, content))
+        used += size
+    if chunk:
+        summary = await _summarize_chunk(llm, summary, chunk, max_tokens)
+    return summary
+
+
+async def _summarize_chunk(llm, summary: str, turns: List[Tuple[str, str]], max_tokens: int) -> str:
+    conversation = '\n'.join(f"{role}: {content}" for role, content in turns)
+    messages = [
+        ("system", SUMMARY_PROMPT.format(max_tokens=max_tokens)),
+        ("human", f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{conversation}")
+    ]
+    return (await llm.ainvoke(messages)).content.strip()
+
+
+class CompiledPrompt:
+    """Prompt prefix of a user: the system prompt and mentagram history as
+    ready message objects, with their token count.
+
+    The prefix is identical on every call, so the provider's prompt cache
+    can serve it. Everything that changes per message (summary, recent
+    turns, language hint, question) goes after it.
+    """
+
+    def __init__(self, system_prompt: str, history: List[Tuple[str, str]], counter: TokenCounter,
+                 language_hint: bool = False):
+        # Imported here, langchain is slow to import and only needed once a prompt is built
+        from langchain_core.messages import convert_to_messages
+        self.prefix = convert_to_messages([("system", system_prompt), *history])
+        self.language_hint = language_hint
+        # Tokens of the prefix and the language hint
+        self.fixed_tokens = counter.count_messages([("system", system_prompt), *history])
+        if language_hint:
+            self.fixed_tokens += MESSAGE_OVERHEAD + counter.count(LANGUAGE_HINT)
+
+    def messages(self, conversation: List[Tuple[str, str]], question: str, language: str) -> list:
+        """Returns the full prompt: prefix, conversation, language hint and question."""
+        suffix = list(conversation)
+        if self.language_hint:
+            suffix.append(("system", LANGUAGE_HINT.format(language=language)))
+        suffix.append(("human", question))
+        from langchain_core.messages import convert_to_messages
+        return self.prefix + convert_to_messages(suffix)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sum(sys.getsizeof(message.content) for message in self.prefix)
+
+
+def compile_prompt(init_data: dict, default_system_prompt: str, counter: TokenCounter) -> CompiledPrompt:
+    """Builds the prompt prefix from the mentagram init data. The default
+    system prompt asks for the language of each message."""
+    history = []
+    if 'chat_history' in init_data and isinstance(init_data['chat_history'], list):
+        for entry in init_data['chat_history']:
+            if isinstance(entry, list) and len(entry) == 2:
+                history.append((entry[0], entry[1]))
+    if 'system_prompt' in init_data:
+        return CompiledPrompt(init_data['system_prompt'], history, counter)
+    return CompiledPrompt(default_system_prompt, history, counter, language_hint=True)
@@ -0,0 +1,108 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+
+def update_key(message: dict) -> str:
+    """Identity of a Telegram message: message ids are unique within a chat."""
+    return f"{message['chat']['id']}:{message['message_id']}"
+
+
+class UpdateDeduplicator:
+    """Drops repeated deliveries of the same update.
+
+    Keys of the last max_entries processed updates are kept in memory and
+    appended to a small index file, so they survive restarts; the file is
+    compacted when it grows to twice that size. Updates still queued or
+    being processed are tracked in memory only: a duplicate of one of them
+    is attached to the running job, which sends the single reply. An
+    in-flight entry older than in_flight_timeout seconds is assumed lost,
+    e.g. a job dropped by the queue, and the update is accepted again.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = 10000, in_flight_timeout: float = 600.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.in_flight_timeout = in_flight_timeout
+        self.in_flight = {}  # key -> monotonic start time
+        self.done = OrderedDict()  # keys of processed updates, oldest first
+        self.index_lines = 0
+        # Counters
+        self.accepted = 0
+        self.duplicates_in_flight = 0
+        self.duplicates_done = 0
+        self._load()
+
+    def begin(self, key: str) -> str:
+        """Registers an incoming update. Returns 'new' if it should be
+        processed, or 'in_flight' / 'done' for a duplicate."""
+        if key in self.done:
+            self.duplicates_done += 1
+            return 'done'
+        started = self.in_flight.get(key)
+        if started is not None and time.monotonic() - started < self.in_flight_timeout:
+            self.duplicates_in_flight += 1
+            return 'in_flight'
+        if len(self.in_flight) >= self.max_entries:
+            now = time.monotonic()
+            self.in_flight = {k: t for k, t in self.in_flight.items() if now - t < self.in_flight_timeout}
+        self.in_flight[key] = time.monotonic()
+        self.accepted += 1
+        return 'new'
+
+    def cancel(self, key: str) -> None:
+        """Forgets an update that wasn't processed, so a redelivery is accepted."""
+        self.in_flight.pop(key, None)
+
+    def finish(self, key: str) -> None:
+        """Marks an update as processed, whatever the outcome."""
+        self.in_flight.pop(key, None)
+        self.done[key] = None
+        while len(self.done) > self.max_entries:
+            self.done.popitem(last=False)
+        self._append(key)
+
+    def _load(self) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            keys = [line.strip() for line in f if line.strip()]
+        self.index_lines = len(keys)
+        for key in keys[-self.max_entries:]:
+            self.done[key] = None
+        logger.info(f"Loaded {len(self.done)} processed update keys")
+
+    def _append(self, key: str) -> None:
+        if self.path is None:
+            return
+        try:
+            if self.index_lines >= 2 * self.max_entries:
+                self._compact()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(key + '\n')
+            self.index_lines += 1
+        except OSError as e:
+            logger.warning(f"Can't update the dedup index: {e}")
+
+    def _compact(self) -> None:
+        """Rewrites the index with the keys kept in memory, without the key being added."""
+        tmp_path = self.path + '.tmp'
+        keys = list(self.done)[:-1]
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(key + '\n' for key in keys)
+        os.replace(tmp_path, self.path)
+        self.index_lines = len(keys)
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "in_flight": len(self.in_flight),
+            "remembered": len(self.done),
+            "duplicates_in_flight": self.duplicates_in_flight,
+            "duplicates_done": self.duplicates_done
+        }
@@ -0,0 +1,262 @@
+import os
+import json
+import struct
+import logging
+import threading
+from datetime import datetime
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+LOG_FILE = 'history.jsonl'
+INDEX_FILE = 'history.idx'
+SUMMARY_FILE = 'summary.json'
+# Files in the user directory that are not legacy chat messages
+RESERVED_FILES = {'init_config.json', 'languages.json', 'summary.json'}
+
+# Each index entry is the byte offset of a record in the log, little-endian uint64
+_OFFSET = struct.Struct('<Q')
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _user_lock(user_dir: str) -> threading.Lock:
+    with _locks_guard:
+        if user_dir not in _locks:
+            _locks[user_dir] = threading.Lock()
+        return _locks[user_dir]
+
+
+def legacy_message_to_turns(message_data: dict) -> List[Tuple[str, str]]:
+    """Converts a legacy per-message JSON file into (role, content) tuples.
+
+    Handles the three on-disk formats written by earlier versions:
+    {"user", "assistant"}, {"content": {"user_message", "assistant_response"}}
+    and the single message formats {"role", "content"} / {role: text}.
+    """
+    if 'user' in message_data and 'assistant' in message_data:
+        # New format
+        return [
+            ("user", message_data['user']),
+            ("assistant", message_data['assistant'])
+        ]
+    if isinstance(message_data.get('content'), dict):
+        # Old conversation format
+        content = message_data['content']
+        return [
+            ("user", content['user_message']),
+            ("assistant", content['assistant_response'])
+        ]
+    if 'role' in message_data and 'content' in message_data:
+        # Legacy single message format
+        return [(message_data['role'], message_data['content'])]
+    # Single message written as {role: text}
+    return [(role, text) for role, text in message_data.items() if isinstance(text, str)]
+
+
+def flatten_records(records: List[List[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+    """Joins conversation records into a single list of (role, content) turns."""
+    return [turn for record in records for turn in record]
+
+
+class HistoryStore:
+    """Append-only conversation log for a single user.
+
+    Turns are stored one JSON object per line in history.jsonl. A sidecar
+    history.idx holds the byte offset of every record, so appending is O(1)
+    and the newest N turns are read with two seeks, regardless of how long
+    the conversation is.
+    """
+
+    def __init__(self, user_dir: str):
+        self.user_dir = user_dir
+        self.log_path = os.path.join(user_dir, LOG_FILE)
+        self.index_path = os.path.join(user_dir, INDEX_FILE)
+        self.summary_path = os.path.join(user_dir, SUMMARY_FILE)
+        self.lock = _user_lock(user_dir)
+
+    def append(self, turns: List[Tuple[str, str]], message_id: str = None) -> None:
+        """Appends one conversation record made of (role, content) turns."""
+        record = {
+            'ts': datetime.now().strftime('%Y%m%d_%H%M%S'),
+            'message_id': message_id,
+            'turns': [list(turn) for turn in turns]
+        }
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            self._prepare()
+            with open(self.log_path, 'ab') as log_file:
+                offset = log_file.tell()
+                log_file.write(line)
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(_OFFSET.pack(offset))
+
+    def count(self) -> int:
+        """Returns the number of stored records."""
+        with self.lock:
+            self._prepare()
+            return os.path.getsize(self.index_path) // _OFFSET.size
+
+    def read_recent_records(self, n: int) -> List[List[Tuple[str, str]]]:
+        """Returns the newest n records as lists of (role, content) turns, oldest first."""
+        with self.lock:
+            self._prepare()
+            total = os.path.getsize(self.index_path) // _OFFSET.size
+            return self._read_records(max(total - n, 0), total)
+
+    def read_range(self, start: int, end: int) -> List[Tuple[str, str]]:
+        """Returns the (role, content) turns of records [start, end), oldest first."""
+        with self.lock:
+            self._prepare()
+            total = os.path.getsize(self.index_path) // _OFFSET.size
+            return flatten_records(self._read_records(max(start, 0), min(end, total)))
+
+    def clear(self) -> None:
+        """Drops every stored record."""
+        with self.lock:
+            os.makedirs(self.user_dir, exist_ok=True)
+            # Migrate first, so legacy files can't reappear as history later
+            self._prepare()
+            open(self.log_path, 'wb').close()
+            open(self.index_path, 'wb').close()
+            if os.path.exists(self.summary_path):
+                os.remove(self.summary_path)
+
+    def read_summary(self) -> dict:
+        """Returns the rolling summary of the oldest records as
+        {'text': summary, 'records': number of records it covers}."""
+        if not os.path.exists(self.summary_path):
+            return {'text': '', 'records': 0}
+        with open(self.summary_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_summary(self, text: str, records: int) -> None:
+        """Stores the summary of records [0, records)."""
+        tmp_path = self.summary_path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'text': text, 'records': records}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.summary_path)
+
+    def _read_records(self, start: int, end: int) -> List[List[Tuple[str, str]]]:
+        if start >= end:
+            return []
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(start * _OFFSET.size)
+            (first_offset,) = _OFFSET.unpack(index_file.read(_OFFSET.size))
+            if end * _OFFSET.size < os.path.getsize(self.index_path):
+                index_file.seek(end * _OFFSET.size)
+                (end_offset,) = _OFFSET.unpack(index_file.read(_OFFSET.size))
+            else:
+                end_offset = None
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(first_offset)
+            data = log_file.read() if end_offset is None else log_file.read(end_offset - first_offset)
+        return [
+            [tuple(turn) for turn in json.loads(line)['turns']]
+            for line in data.decode('utf-8').splitlines() if line
+        ]
+
+    def _prepare(self) -> None:
+        """Creates the log on first use and repairs the index after a crash.
+        Must be called with the lock held."""
+        if not os.path.exists(self.log_path):
+            os.makedirs(self.user_dir, exist_ok=True)
+            migrate_legacy_history(self.user_dir, self)
+            self._rebuild_index()
+        elif not self._index_is_consistent():
+            logger.info(f"Rebuilding history index: {self.index_path}")
+            self._rebuild_index()
+
+    def _index_is_consistent(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        index_size = os.path.getsize(self.index_path)
+        log_size = os.path.getsize(self.log_path)
+        if index_size % _OFFSET.size:
+            return False
+        if index_size == 0:
+            return log_size == 0
+        # The last indexed record must end exactly where the log ends
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(index_size - _OFFSET.size)
+            (last_offset,) = _OFFSET.unpack(index_file.read(_OFFSET.size))
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(last_offset)
+            log_file.readline()
+            return log_file.tell() == log_size
+
+    def _rebuild_index(self) -> None:
+        offsets = []
+        with open(self.log_path, 'rb+') as log_file:
+            offset = 0
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash, drop the partial record
+                    log_file.truncate(offset)
+                    break
+                offsets.append(offset)
+                offset += len(line)
+        with open(self.index_path, 'wb') as index_file:
+            for offset in offsets:
+                index_file.write(_OFFSET.pack(offset))
+
+
+def migrate_legacy_history(user_dir: str, store: HistoryStore = None) -> int:
+    """One-shot migration of per-message JSON files into the append-only log.
+
+    Legacy files are replayed in creation time order and removed once the
+    log is written. Returns the number of migrated files.
+    """
+    store = store or HistoryStore(user_dir)
+    files = []
+    if os.path.isdir(user_dir):
+        for f in os.listdir(user_dir):
+            if f.endswith('.json') and f not in RESERVED_FILES:
+                filepath = os.path.join(user_dir, f)
+                files.append((filepath, os.path.getctime(filepath)))
+    # Sort files by creation time (oldest first)
+    files.sort(key=lambda x: x[1])
+
+    # Build the new log aside and swap it in, so a crash can't lose messages
+    tmp_path = store.log_path + '.tmp'
+    migrated = []
+    with open(tmp_path, 'wb') as log_file:
+        for filepath, created in files:
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    turns = legacy_message_to_turns(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Skipping unreadable history file {filepath}: {e}")
+                continue
+            record = {
+                'ts': datetime.fromtimestamp(created).strftime('%Y%m%d_%H%M%S'),
+                'message_id': os.path.splitext(os.path.basename(filepath))[0].split('_')[-1],
+                'turns': [list(turn) for turn in turns]
+            }
+            log_file.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            migrated.append(filepath)
+    if os.path.exists(store.index_path):
+        os.remove(store.index_path)
+    os.replace(tmp_path, store.log_path)
+    for filepath in migrated:
+        os.remove(filepath)
+    if migrated:
+        logger.info(f"Migrated {len(migrated)} history files in {user_dir}")
+    return len(migrated)
+
+
+if __name__ == "__main__":
+    # Migrate every user directory at once instead of lazily on first message
+    logging.basicConfig(level=logging.INFO)
+    users_dir = 'data/users'
+    for user_id in sorted(os.listdir(users_dir)):
+        user_dir = os.path.join(users_dir, user_id)
+        if os.path.isdir(user_dir) and not os.path.exists(os.path.join(user_dir, LOG_FILE)):
+            store = HistoryStore(user_dir)
+            with store.lock:
+                migrate_legacy_history(user_dir, store)
+            print(f"{user_id}: migrated")
@@ -0,0 +1,116 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+OVERFLOW_POLICIES = ('reject', 'drop_oldest')
+
+
+class UserJobQueue:
+    """Background job queue with per-user FIFO ordering.
+
+    Jobs of the same user run strictly one after another, in submission
+    order, while jobs of different users are drained in parallel by a pool
+    of asyncio workers. A job is a coroutine function called with the time
+    in seconds it spent waiting in the queue.
+    """
+
+    def __init__(self, workers: int = 8, max_depth: int = 100, overflow: str = 'reject'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.workers = workers
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.pending = {}  # user_id -> deque of (job, enqueued_at)
+        self.ready = None  # user ids with pending jobs and no job running
+        self.depth = 0
+        self.tasks = []
+        # Counters
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self) -> None:
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Job queue started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, user_id: str, job) -> bool:
+        """Enqueues a job. Returns False if it was rejected by backpressure."""
+        if self.depth >= self.max_depth:
+            if self.overflow == 'reject':
+                self.rejected += 1
+                logger.warning(f"Job queue full ({self.depth}), rejected job of user {user_id}")
+                return False
+            self._drop_oldest()
+        if user_id not in self.pending:
+            self.pending[user_id] = deque()
+            # Only users without a job in flight are handed to the workers
+            self.ready.put_nowait(user_id)
+        self.pending[user_id].append((job, time.time()))
+        self.depth += 1
+        return True
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "users": len(self.pending),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "wait_avg": round(self.wait_total / started, 3) if started else 0.0,
+            "wait_max": round(self.wait_max, 3)
+        }
+
+    def _drop_oldest(self) -> None:
+        # Heads of the per-user queues are the oldest job of each user
+        user_id = min(
+            (u for u, jobs in self.pending.items() if jobs),
+            key=lambda u: self.pending[u][0][1]
+        )
+        self.pending[user_id].popleft()
+        self.depth -= 1
+        self.dropped += 1
+        logger.warning(f"Job queue full, dropped oldest job of user {user_id}")
+
+    async def _worker(self) -> None:
+        while True:
+            user_id = await self.ready.get()
+            jobs = self.pending[user_id]
+            if jobs:
+                job, enqueued_at = jobs.popleft()
+                self.depth -= 1
+                wait = time.time() - enqueued_at
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                logger.info(f"Running job of user {user_id} after {round(wait, 3)} sec. in queue")
+                try:
+                    await job(wait)
+                    self.completed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Job of user {user_id} failed: {e}")
+            if jobs:
+                # Next job of the same user goes to the back of the line
+                self.ready.put_nowait(user_id)
+            else:
+                del self.pending[user_id]
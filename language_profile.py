@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+PROFILE_FILE = 'languages.json'
+
+
+def load_languages(path: str) -> List[str]:
+    """Reads the supported BCP-47 language codes, one per line."""
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_profile(user_dir: str) -> dict:
+    """Returns how many times each language was detected for a user, keyed by lowercase code."""
+    profile_path = os.path.join(user_dir, PROFILE_FILE)
+    if os.path.exists(profile_path):
+        with open(profile_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_profile(user_dir: str, profile: dict) -> None:
+    os.makedirs(user_dir, exist_ok=True)
+    tmp_path = os.path.join(user_dir, PROFILE_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, os.path.join(user_dir, PROFILE_FILE))
+
+
+def record_language(profile: dict, language_code: str) -> dict:
+    """Returns the profile with one more detection of language_code."""
+    profile = dict(profile)
+    key = language_code.lower()
+    profile[key] = profile.get(key, 0) + 1
+    return profile
+
+
+def rank_languages(profile: dict, languages: List[str], max_candidates: int, min_samples: int) -> List[str]:
+    """Returns the user's most frequent supported languages, most frequent first.
+
+    Falls back to the full list while the profile holds fewer than
+    min_samples detections.
+    """
+    if sum(profile.values()) < min_samples:
+        return languages
+    ranked = sorted(
+        (code for code in languages if profile.get(code.lower())),
+        key=lambda code: -profile[code.lower()]
+    )
+    return ranked[:max_candidates] or languages
@@ -0,0 +1,310 @@
+"""End-to-end load test of the bot against local stand-ins.
+
+Starts the bot server in-process with a stub Telegram Bot API on :8081, a
+stub TTS server, a fake Speech-to-Text client and a fake LLM, then replays
+Telegram update payloads into POST /message at a fixed rate. No OpenAI,
+Google or TTS GPU server is involved.
+
+An update is complete when its queued job has finished; end-to-end latency
+is measured from the POST to that moment. Updates the server rejects,
+whose job raises, that get a "Sorry, ..." reply or that don't finish
+within --timeout count as errors.
+
+With --duplicates, a share of the updates is delivered a second time, like
+Telegram retrying a webhook; the server should drop the copies.
+
+Usage:
+    python loadtest/run_load.py --rate 5 --concurrency 50 --updates-count 200
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import itertools
+import subprocess
+import tempfile
+from collections import Counter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import aiohttp
+import uvicorn
+
+from stubs import StubBotAPI, StubTTSServer, FakeSpeechClient, FakeLLM, start_site
+
+BOT_API_PORT = 8081  # Fixed in server.py
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+def latency_summary(values: list) -> dict:
+    return {
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p95_ms': round(percentile(values, 95) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+        'max_ms': round(max(values) * 1000, 1) if values else 0.0
+    }
+
+
+def generate_voice(path: str, duration: int) -> None:
+    """Writes an OGG/Opus voice note, as Telegram stores them: a tone
+    with a second of silence before and after it."""
+    subprocess.run([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f"sine=frequency=220:duration={max(duration - 2, 1)}:sample_rate=48000",
+        '-af', 'adelay=1000,apad=pad_dur=1',
+        '-ac', '1', '-c:a', 'libopus', '-f', 'ogg', path
+    ], check=True)
+
+
+def setup_workdir(args) -> str:
+    """Creates a working directory with the config and data files the server reads."""
+    workdir = tempfile.mkdtemp(prefix='voclone_load_')
+    config = {
+        'TOKEN': '1:loadtest',
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'LANGSMITH_API_KEY': 'loadtest',
+        'LANGSMITH_PROJECT': 'loadtest',
+        'TTS_API_URLS': [f'http://127.0.0.1:{args.tts_port + i}' for i in range(args.tts_servers)],
+    }
+    for item in args.set:
+        key, value = item.split('=', 1)
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    for name in ['BCP-47.txt', 'greeting.txt', 'mentagram.json']:
+        shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    generate_voice(os.path.join(workdir, 'voice.ogg'), args.voice_duration)
+    os.chdir(workdir)
+    return workdir
+
+
+def load_templates(path: str) -> list:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LoadRun:
+    """Tracks every replayed update until its job completes."""
+
+    def __init__(self):
+        self.pending = {}  # message_id -> future resolved with an error or None
+        self.sent = {}  # message_id -> POST time
+        self.ack_latencies = []
+        self.latencies = []
+        self.errors = Counter()
+        self.duplicates = 0
+
+    def track(self, server):
+        """Wraps the server's job handler, to learn when each update is done."""
+        handle_message = server.handle_message
+
+        async def tracked(message, queue_wait=0.0):
+            error = None
+            try:
+                await handle_message(message, queue_wait)
+            except Exception as e:
+                error = f'exception: {type(e).__name__}'
+                raise
+            finally:
+                future = self.pending.get(message['message_id'])
+                if future is not None and not future.done():
+                    future.set_result(error)
+
+        server.handle_message = tracked
+
+
+async def send_update(session, url, run: LoadRun, bot_api: StubBotAPI, message: dict, timeout: float):
+    message_id = message['message_id']
+    future = asyncio.get_running_loop().create_future()
+    run.pending[message_id] = future
+    start = time.monotonic()
+    try:
+        async with session.post(url, json=message) as response:
+            body = await response.json()
+        run.ack_latencies.append(time.monotonic() - start)
+        if response.status != 200:
+            run.errors[f'http {response.status}'] += 1
+            return
+        if body.get('type') != 'empty':
+            # Rejected by backpressure
+            run.errors['rejected'] += 1
+            return
+        error = await asyncio.wait_for(future, timeout)
+        if error is None and message_id in bot_api.errors:
+            error = 'error reply'
+        if error:
+            run.errors[error] += 1
+        else:
+            run.latencies.append(time.monotonic() - start)
+    except asyncio.TimeoutError:
+        run.errors['timeout'] += 1
+    except aiohttp.ClientError as e:
+        run.errors[f'client: {type(e).__name__}'] += 1
+    finally:
+        run.pending.pop(message_id, None)
+
+
+async def generate_load(args, run: LoadRun, bot_api: StubBotAPI) -> float:
+    """Posts updates at args.rate per second, keeping at most
+    args.concurrency of them in flight. Returns the wall time."""
+    templates = load_templates(args.updates)
+    url = f'http://127.0.0.1:{args.port}/message'
+    semaphore = asyncio.Semaphore(args.concurrency)
+    message_ids = itertools.count(1)
+    tasks = []
+    rng = random.Random(1)
+
+    async def redeliver(message, delay):
+        await asyncio.sleep(delay)
+        run.duplicates += 1
+        try:
+            async with session.post(url, json=message) as response:
+                await response.read()
+        except aiohttp.ClientError as e:
+            run.errors[f'client: {type(e).__name__}'] += 1
+
+    async def bounded(message):
+        try:
+            await send_update(session, url, run, bot_api, message, args.timeout)
+        finally:
+            semaphore.release()
+
+    start = time.monotonic()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        for i in range(args.updates_count):
+            if args.rate > 0:
+                delay = start + i / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await semaphore.acquire()
+            user_id = 100000 + i % args.users
+            message = json.loads(json.dumps(templates[i % len(templates)]))
+            message['message_id'] = next(message_ids)
+            message['from']['id'] = user_id
+            message['chat']['id'] = user_id
+            message['date'] = int(time.time())
+            tasks.append(asyncio.create_task(bounded(message)))
+            if rng.random() < args.duplicates:
+                tasks.append(asyncio.create_task(redeliver(message, rng.uniform(0, 2 * args.llm_latency))))
+        await asyncio.gather(*tasks)
+    return time.monotonic() - start
+
+
+async def main_async(args) -> dict:
+    # Imported here: the server reads config.json from the working directory
+    import server
+    import stt_tools
+
+    if not args.verbose:
+        for name in ['server', 'stt_tools', 'tts_tools', 'audio_tools', 'history_store', 'job_queue',
+                     'tts_cache', 'tts_backends', 'user_cache', 'context_builder', 'language_profile', 'dedup', 'httpx']:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    os.environ['LANGSMITH_TRACING'] = 'false'
+
+    speech_client = FakeSpeechClient(args.stt_latency, args.stt_rtf)
+    stt_tools._client = speech_client
+    llm = FakeLLM(args.llm_latency, args.llm_tokens_per_second, **({'answer': args.llm_answer} if args.llm_answer else {}))
+    server.llm = llm
+
+    run = LoadRun()
+    run.track(server)
+    bot_api = StubBotAPI(os.path.abspath('voice.ogg'), args.bot_api_latency)
+    tts_servers = [StubTTSServer(args.tts_latency, char_latency=args.tts_char_latency) for _ in range(args.tts_servers)]
+    runners = [await start_site(bot_api.app(), BOT_API_PORT)]
+    for i, tts_server in enumerate(tts_servers):
+        runners.append(await start_site(tts_server.app(), args.tts_port + i))
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=args.port, log_level='warning'))
+    serving = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        print(f"Replaying {args.updates_count} updates at {args.rate or 'max'}/s, concurrency {args.concurrency}, {args.users} users")
+        wall_time = await generate_load(args, run, bot_api)
+    finally:
+        uvicorn_server.should_exit = True
+        await serving
+        for runner in runners:
+            await runner.cleanup()
+
+    failed = sum(run.errors.values())
+    return {
+        'updates': args.updates_count,
+        'completed': len(run.latencies),
+        'errors': dict(run.errors),
+        'duplicates_sent': run.duplicates,
+        'error_rate': round(failed / args.updates_count, 4) if args.updates_count else 0.0,
+        'wall_time_s': round(wall_time, 2),
+        'throughput_per_s': round(len(run.latencies) / wall_time, 2) if wall_time else 0.0,
+        'end_to_end': latency_summary(run.latencies),
+        'ack': latency_summary(run.ack_latencies),
+        'calls': {
+            'bot_api': dict(bot_api.calls),
+            'tts': [tts_server.requests for tts_server in tts_servers],
+            'stt': speech_client.requests,
+            'llm': llm.requests
+        },
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', default=os.path.join(REPO_DIR, 'loadtest', 'updates.jsonl'),
+                        help='Telegram message payloads to replay, one JSON object per line')
+    parser.add_argument('--updates-count', type=int, default=100, help='Updates to send')
+    parser.add_argument('--rate', type=float, default=5.0, help='Updates per second, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=50, help='Most updates in flight at once')
+    parser.add_argument('--users', type=int, default=20, help='Distinct simulated users')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds until an update counts as lost')
+    parser.add_argument('--port', type=int, default=4223, help='Port of the bot server')
+    parser.add_argument('--tts-port', type=int, default=5055, help='Port of the first stub TTS server')
+    parser.add_argument('--tts-servers', type=int, default=1, help='Stub TTS servers, on consecutive ports')
+    parser.add_argument('--tts-latency', type=float, default=1.0, help='Seconds per /tts call')
+    parser.add_argument('--tts-char-latency', type=float, default=0.0, help='Extra /tts seconds per character of text')
+    parser.add_argument('--stt-latency', type=float, default=0.3, help='Seconds per recognition')
+    parser.add_argument('--stt-rtf', type=float, default=0.1, help='Recognition seconds per second of audio')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='Seconds until the first token')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=30.0)
+    parser.add_argument('--llm-answer', help='Text of every LLM answer')
+    parser.add_argument('--bot-api-latency', type=float, default=0.0, help='Seconds per Bot API call')
+    parser.add_argument('--voice-duration', type=int, default=5, help='Seconds of the generated voice note')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Share of updates delivered twice')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Server config.json setting, e.g. --set TTS_STREAMING=true')
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help='Keep the server INFO logs')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = setup_workdir(args)
+    try:
+        report = asyncio.run(main_async(args))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({key: value for key, value in report.items() if key != 'settings'}, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Local stand-ins for the services the bot depends on.
+
+- StubBotAPI: the subset of the Telegram Bot API the bot calls
+  (getFile, sendMessage, sendVoice, sendPhoto, sendDocument, editMessageText).
+- StubTTSServer: the TTS server, with a configurable /tts latency and a
+  /tts_batch endpoint.
+- FakeSpeechClient: replaces the Google Speech-to-Text client.
+- FakeLLM: replaces ChatOpenAI, answering after a configurable delay.
+"""
+import json
+import time
+import base64
+import asyncio
+import logging
+from collections import Counter
+
+import numpy as np
+from aiohttp import web
+from google.cloud import speech
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from audio_tools import pcm_to_wav, SAMPLE_RATE, SAMPLE_WIDTH
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+class StubBotAPI:
+    """Bot API server answering like a local telegram-bot-api instance.
+
+    getFile returns voice_path as the local file path of every file. Every
+    call is counted, and replies starting with "Sorry" are recorded as
+    errors of the message they reply to.
+    """
+
+    def __init__(self, voice_path: str, latency: float = 0.0):
+        self.voice_path = voice_path
+        self.latency = latency
+        self.calls = Counter()
+        self.errors = {}  # message_id -> error text sent to the user
+        self.next_message_id = 1_000_000_000
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(request.query)
+        if request.content_type == 'multipart/form-data':
+            async for part in await request.multipart():
+                params[part.name] = await part.read() if part.filename else await part.text()
+        else:
+            params.update(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = int(params.get('chat_id', 0))
+        if method == 'getFile':
+            return self.ok({
+                'file_id': params.get('file_id'),
+                'file_unique_id': params.get('file_id'),
+                'file_size': 0,
+                'file_path': self.voice_path
+            })
+        if method == 'sendMessage':
+            text = params.get('text', '')
+            reply_to = self.reply_to(params)
+            if text.startswith('Sorry') and reply_to is not None:
+                self.errors[reply_to] = text
+            return self.ok(self.message(chat_id, text=text))
+        if method in ('sendVoice', 'sendPhoto', 'sendDocument'):
+            return self.ok(self.message(chat_id))
+        if method == 'editMessageText':
+            return self.ok(self.message(chat_id, message_id=int(params.get('message_id', 0)), text=params.get('text', '')))
+        return web.json_response({'ok': False, 'error_code': 404, 'description': f'Not Found: {method}'}, status=404)
+
+    @staticmethod
+    def reply_to(params: dict):
+        """Returns the id of the message replied to, or None."""
+        if 'reply_parameters' in params:
+            return json.loads(params['reply_parameters'])['message_id']
+        if 'reply_to_message_id' in params:
+            return int(params['reply_to_message_id'])
+        return None
+
+    def message(self, chat_id: int, message_id: int = None, text: str = None) -> dict:
+        if message_id is None:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+
+class StubTTSServer:
+    """TTS server answering every /tts call with the same speech after
+    latency + char_latency * len(text) seconds.
+
+    A /tts_batch call of n texts takes latency * (1 + batch_cost * (n - 1))
+    seconds, plus char_latency per character of its longest text, modelling a GPU that synthesizes a batch for little more than
+    the cost of one text. With serial, calls wait for each other, like
+    requests sharing a single GPU.
+    """
+
+    def __init__(self, latency: float = 1.0, speech_duration: float = 3.0, batch_cost: float = 0.1,
+                 serial: bool = False, char_latency: float = 0.0):
+        self.latency = latency
+        self.char_latency = char_latency
+        self.batch_cost = batch_cost
+        self.serial = serial
+        self.gpu = None  # Created on first use, inside the event loop
+        self.requests = 0
+        self.batches = 0
+        samples = np.arange(int(SAMPLE_RATE * speech_duration)) / SAMPLE_RATE
+        tone = (0.3 * np.sin(2 * np.pi * 220 * samples) * 32767).astype('<i2')
+        self.speech = pcm_to_wav(tone.tobytes())
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/tts', self.tts)
+        app.router.add_post('/tts_batch', self.tts_batch)
+        app.router.add_post('/upload_reference', self.upload_reference)
+        return app
+
+    async def compute(self, seconds: float) -> None:
+        if not self.serial:
+            await asyncio.sleep(seconds)
+            return
+        if self.gpu is None:
+            self.gpu = asyncio.Lock()
+        async with self.gpu:
+            await asyncio.sleep(seconds)
+
+    async def tts(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.requests += 1
+        await self.compute(self.latency + self.char_latency * len(payload['text']))
+        return web.Response(body=self.speech, content_type='audio/wav')
+
+    async def tts_batch(self, request: web.Request) -> web.Response:
+        items = (await request.json())['items']
+        self.requests += len(items)
+        self.batches += 1
+        await self.compute(self.latency * (1 + self.batch_cost * (len(items) - 1))
+                           + self.char_latency * max(len(item['text']) for item in items))
+        audio = base64.b64encode(self.speech).decode('ascii')
+        return web.json_response({'results': [{'audio': audio} for _ in items]})
+
+    async def upload_reference(self, request: web.Request) -> web.Response:
+        await request.post()
+        return web.json_response({'message': 'Reference file uploaded'})
+
+
+class FakeSpeechClient:
+    """Speech-to-Text client that takes latency + rtf * audio seconds to
+    recognize every recording as the same phrase."""
+
+    def __init__(self, latency: float = 0.3, rtf: float = 0.1, transcript: str = "What a nice day, tell me a story."):
+        self.latency = latency
+        self.rtf = rtf
+        self.transcript = transcript
+        self.requests = 0
+
+    def _alternatives(self) -> list:
+        return [speech.SpeechRecognitionAlternative(transcript=self.transcript, confidence=0.92)]
+
+    def recognize(self, config, audio):
+        self.requests += 1
+        seconds = len(audio['content']) / (SAMPLE_RATE * SAMPLE_WIDTH)
+        time.sleep(self.latency + self.rtf * seconds)
+        return speech.RecognizeResponse(results=[speech.SpeechRecognitionResult(
+            alternatives=self._alternatives(), language_code=config['language_code'].lower()
+        )])
+
+    def streaming_recognize(self, config, requests):
+        self.requests += 1
+        size = sum(len(request.audio_content) for request in requests)
+        time.sleep(self.latency + self.rtf * size / (SAMPLE_RATE * SAMPLE_WIDTH))
+        yield speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+            alternatives=self._alternatives(), language_code=config.config.language_code.lower(), is_final=True
+        )])
+
+
+class FakeLLM:
+    """Chat model stand-in: answers after latency seconds, streaming
+    tokens_per_second when used with astream."""
+
+    model_name = 'gpt-4'
+
+    def __init__(self, latency: float = 1.0, tokens_per_second: float = 30.0,
+                 answer: str = "Once upon a time there was a little robot. It loved the sea. Every evening it watched the sunset."):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer = answer
+        self.requests = 0
+
+    def _usage(self, messages) -> dict:
+        prompt_tokens = sum(len(str(getattr(m, 'content', m)).split()) for m in messages)
+        return {
+            'input_tokens': prompt_tokens,
+            'output_tokens': len(self.answer.split()),
+            'total_tokens': prompt_tokens + len(self.answer.split())
+        }
+
+    async def ainvoke(self, messages):
+        self.requests += 1
+        words = self.answer.split(' ')
+        await asyncio.sleep(self.latency + len(words) / self.tokens_per_second)
+        return AIMessage(content=self.answer, usage_metadata=self._usage(messages))
+
+    async def astream(self, messages):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        words = self.answer.split(' ')
+        for i, word in enumerate(words):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield AIMessageChunk(content=word if i == 0 else ' ' + word)
+        yield AIMessageChunk(content='', usage_metadata=self._usage(messages))
@@ -0,0 +1,108 @@
+import json
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+
+from prometheus_client import Histogram, Counter
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    'voclone_stage_seconds',
+    'Duration of a pipeline stage',
+    ['stage', 'kind', 'language', 'audio'],
+    buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'voclone_request_seconds',
+    'Duration of a processed message, from dequeue to the last reply',
+    ['kind', 'language', 'audio', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+SLOW_REQUESTS = Counter(
+    'voclone_slow_requests_total',
+    'Messages that took longer than SLOW_REQUEST_SECONDS',
+    ['kind']
+)
+DUPLICATE_UPDATES = Counter(
+    'voclone_duplicate_updates_total',
+    'Repeated deliveries of an update, by the state of the original',
+    ['state']
+)
+
+
+def audio_bucket(duration) -> str:
+    """Coarse audio duration label, so histograms stay low-cardinality."""
+    if duration is None:
+        return 'none'
+    for limit in (10, 30, 60, 120):
+        if duration < limit:
+            return f'<{limit}s'
+    return '>=120s'
+
+
+class RequestTrace:
+    """Stage spans of a single message, tagged with the user, the language
+    and the audio duration.
+
+    Spans are kept until finish(), because tags like the language are only
+    known after speech recognition; then all of them are exported to the
+    Prometheus histograms at once. Unfinished traces are never exported, so
+    callers finish failed requests too, with outcome set to 'error'.
+    """
+
+    def __init__(self, user_id: str, kind: str, language: str = None, audio_duration: float = None,
+                 slow_seconds: float = 0):
+        self.user_id = user_id
+        self.kind = kind
+        self.language = language
+        self.audio_duration = audio_duration
+        self.slow_seconds = slow_seconds
+        self.outcome = 'ok'
+        self.start_time = time.time()
+        self.spans = []  # (stage, seconds) in completion order
+        self.timings = {}  # stage -> total seconds, rounded
+
+    @contextmanager
+    def stage(self, name: str):
+        """Records the wall time of a pipeline stage."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time)
+
+    def record(self, name: str, seconds: float) -> None:
+        """Adds a span measured elsewhere. Repeated stages add up in timings."""
+        self.spans.append((name, seconds))
+        self.timings[name] = round(self.timings.get(name, 0) + seconds, 2)
+
+    def finish(self) -> float:
+        """Exports the spans and returns the total duration in seconds."""
+        total = time.time() - self.start_time
+        language = (self.language or 'unknown').split('-')[0].lower()
+        audio = audio_bucket(self.audio_duration)
+        for name, seconds in self.spans:
+            STAGE_SECONDS.labels(name, self.kind, language, audio).observe(seconds)
+        REQUEST_SECONDS.labels(self.kind, language, audio, self.outcome).observe(total)
+        if self.slow_seconds and total > self.slow_seconds:
+            SLOW_REQUESTS.labels(self.kind).inc()
+            logger.warning("Slow request: " + json.dumps({
+                'user_id': self.user_id,
+                'kind': self.kind,
+                'outcome': self.outcome,
+                'language': self.language,
+                'audio_duration': self.audio_duration,
+                'total': round(total, 2),
+                'stages': [[name, round(seconds, 3)] for name, seconds in self.spans]
+            }, ensure_ascii=False))
+        return total
+
+
+def span(trace, name: str):
+    """trace.stage(name), or a no-op if the call isn't traced."""
+    return trace.stage(name) if trace is not None else nullcontext()
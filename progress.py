@@ -0,0 +1,86 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+# Background updates still running, so they aren't garbage collected
+_tasks = set()
+
+
+class ChatRateLimiter:
+    """Spaces out status updates in the same chat by at least min_interval
+    seconds, to stay within Telegram's per-chat limits."""
+
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self.next_time = {}  # chat_id -> earliest monotonic time of the next update
+
+    def reserve(self, chat_id) -> float:
+        """Reserves the next update slot of a chat. Returns the seconds to wait for it."""
+        now = time.monotonic()
+        if len(self.next_time) > 10000:
+            self.next_time = {chat: t for chat, t in self.next_time.items() if t > now}
+        slot = max(now, self.next_time.get(chat_id, 0.0))
+        self.next_time[chat_id] = slot + self.min_interval
+        return slot - now
+
+
+class ProgressReporter:
+    """Status message of a request, updated in the background.
+
+    update() returns at once. The first update sends the status message as
+    a reply, later ones edit it. While an update is waiting for the chat's
+    rate budget or for the Bot API, newer states replace the pending one,
+    so only the latest state is sent. Failed updates are logged and never
+    reach the caller.
+    """
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: int, limiter: ChatRateLimiter,
+                 parse_mode: str = 'MarkdownV2'):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.limiter = limiter
+        self.parse_mode = parse_mode
+        self.message_id = None
+        self.pending = None
+        self.shown = None
+        self.sent = 0
+        self.task = None
+
+    def update(self, text: str) -> None:
+        """Sets the status text, formatted for parse_mode."""
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+            _tasks.add(self.task)
+            self.task.add_done_callback(_tasks.discard)
+
+    async def _flush(self) -> None:
+        while self.pending != self.shown:
+            await asyncio.sleep(self.limiter.reserve(self.chat_id))
+            # Only the newest state is sent
+            text = self.pending
+            try:
+                if self.message_id is None:
+                    message = await self.bot.send_message(
+                        self.chat_id,
+                        text,
+                        reply_to_message_id=self.reply_to_message_id,
+                        parse_mode=self.parse_mode
+                    )
+                    self.message_id = message.message_id
+                else:
+                    await self.bot.edit_message_text(
+                        text,
+                        chat_id=self.chat_id,
+                        message_id=self.message_id,
+                        parse_mode=self.parse_mode
+                    )
+                self.sent += 1
+            except Exception as e:
+                logger.warning(f"Progress update in chat {self.chat_id} failed: {e}")
+            self.shown = text
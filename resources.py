@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+
+def read_text(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_id_set(path: str) -> set:
+    """Reads ids, one per line, into a set for O(1) lookups."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def read_json_bytes(path: str) -> bytes:
+    """Validates a JSON file and pre-serializes it, ready to be sent as a download."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.dumps(json.load(f), ensure_ascii=False, indent=2).encode('utf-8')
+
+
+class Resource:
+    """A file kept in memory as loader(path), reloaded when it changes.
+
+    The file is checked at most every check_interval seconds, by its
+    modification time and size. A missing file gives default; a file that
+    fails to load keeps the previous value.
+    """
+
+    def __init__(self, path: str, loader, default=None, check_interval: float = 1.0):
+        self.path = path
+        self.loader = loader
+        self.default = default
+        self.check_interval = check_interval
+        self.value = default
+        self.signature = None  # (mtime, size) of the loaded file
+        self.checked_at = None
+        self.reloads = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            self._refresh()
+        return self.value
+
+    def _refresh(self) -> None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.signature != 'missing':
+                logger.warning(f"{self.path} not found")
+                self.signature = 'missing'
+                self.value = self.default
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return
+        try:
+            self.value = self.loader(self.path)
+        except Exception as e:
+            logger.error(f"Can't load {self.path}, keeping the previous version: {e}")
+            return
+        if self.signature is not None:
+            self.reloads += 1
+            logger.info(f"Reloaded {self.path}")
+        self.signature = signature
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "loaded": self.signature not in (None, 'missing'),
+            "reloads": self.reloads
+        }
+
+
+class ResourceRegistry:
+    """Static files the bot serves or consults, loaded once and hot-reloaded."""
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self.resources = {}
+
+    def register(self, name: str, path: str, loader, default=None) -> Resource:
+        resource = Resource(path, loader, default, self.check_interval)
+        self.resources[name] = resource
+        resource.get()
+        return resource
+
+    def get(self, name: str):
+        return self.resources[name].get()
+
+    def stats(self) -> dict:
+        return {name: resource.stats() for name, resource in self.resources.items()}
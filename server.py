@@ -1,20 +1,37 @@
 from fastapi import FastAPI, Request, HTTPException, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import os
 import logging
 import json
 import telebot
+import telebot.asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
 from telebot.formatting import escape_markdown
 from datetime import datetime
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from typing import Union
-import requests
-from stt_tools import transcribe_multiple_languages
-import uuid
-from pydub import AudioSegment
-from tts_tools import upload_reference_file, generate_speech
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from stt_tools import transcribe_multiple_languages, transcribe_streaming, get_speech_client
+import io
+from audio_tools import convert_audio_to_pcm, encode_ogg_opus, prepare_reference, concat_speech, SAMPLE_RATE, SAMPLE_WIDTH
+from vad import compact_speech
+from tts_tools import TTSClient
 import time
+import hashlib
+from history_store import HistoryStore, legacy_message_to_turns, flatten_records
+from user_cache import UserCache
+from job_queue import UserJobQueue
+from tts_cache import TTSCache
+from context_builder import TokenCounter, CompiledPrompt, compile_prompt, fit_records, summarize
+from metrics import RequestTrace, span, DUPLICATE_UPDATES
+from dedup import UpdateDeduplicator, update_key
+from text_segmenter import split_sentences, segment_text
+from resources import ResourceRegistry, read_text, read_bytes, read_id_set, read_json_bytes
+from progress import ProgressReporter, ChatRateLimiter
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from language_profile import load_languages, load_profile, save_profile, record_language, rank_languages
 
 # Initialize FastAPI
 app = FastAPI()
@@ -27,7 +44,43 @@ logger.setLevel(logging.INFO)
 # Load config
 with open('config.json') as config_file:
     config = json.load(config_file)
-    HISTORY_THRESHOLD = config.get('HISTORY_THRESHOLD', 4000)  # Default to 4000 chars if not specified
+    HISTORY_TOKEN_BUDGET = config.get('HISTORY_TOKEN_BUDGET', 6000)  # Prompt tokens, the rest of the context is left for the answer
+    HISTORY_SUMMARY_TOKENS = config.get('HISTORY_SUMMARY_TOKENS', 500)  # Length of the summary of older messages
+    HISTORY_LOW_WATER = config.get('HISTORY_LOW_WATER', 0.5)  # Share of the history budget left unsummarized after a summary
+    HISTORY_WINDOW = config.get('HISTORY_WINDOW', 50)  # Newest conversation records considered for the prompt
+    USER_CACHE_MAX_BYTES = config.get('USER_CACHE_MAX_BYTES', 64 * 1024 * 1024)  # Default to 64 MB
+    AUDIO_WORKERS = config.get('AUDIO_WORKERS', os.cpu_count() or 1)  # Concurrent ffmpeg jobs
+    QUEUE_WORKERS = config.get('QUEUE_WORKERS', 8)  # Messages processed in parallel
+    QUEUE_MAX_DEPTH = config.get('QUEUE_MAX_DEPTH', 100)  # Messages waiting before backpressure
+    QUEUE_OVERFLOW = config.get('QUEUE_OVERFLOW', 'reject')  # 'reject' or 'drop_oldest'
+    TTS_STREAMING = config.get('TTS_STREAMING', False)  # Synthesize the LLM answer sentence by sentence
+    TTS_CACHE_MAX_BYTES = config.get('TTS_CACHE_MAX_BYTES', 512 * 1024 * 1024)  # 0 disables the speech cache
+    TTS_TIMEOUT = config.get('TTS_TIMEOUT', 60)  # Deadline of a TTS call in seconds, including retries
+    TTS_RETRIES = config.get('TTS_RETRIES', 3)  # Retries of TTS connection errors
+    TTS_API_URLS = config.get('TTS_API_URLS', [config.get('TTS_API_URL', 'http://localhost:5000')])  # Pool of TTS servers
+    TTS_HEDGE_PERCENTILE = config.get('TTS_HEDGE_PERCENTILE', 0)  # Latency percentile after which a request is also sent to a second server, 0 disables
+    TTS_BREAKER_FAILURES = config.get('TTS_BREAKER_FAILURES', 3)  # Consecutive failures that eject a TTS server
+    TTS_BREAKER_COOLDOWN = config.get('TTS_BREAKER_COOLDOWN', 30)  # Seconds before an ejected TTS server is tried again
+    TTS_HEALTH_INTERVAL = config.get('TTS_HEALTH_INTERVAL', 10)  # Seconds between health checks of ejected TTS servers, 0 disables
+    TTS_BATCH_WINDOW = config.get('TTS_BATCH_WINDOW', 0)  # Seconds to collect concurrent texts into one /tts_batch call, 0 disables
+    TTS_BATCH_MAX_SIZE = config.get('TTS_BATCH_MAX_SIZE', 8)  # Most texts in a TTS batch
+    TTS_SEGMENT_CONCURRENCY = config.get('TTS_SEGMENT_CONCURRENCY', 4)  # Segments of an answer synthesized at once
+    TTS_SEGMENT_MAX_CHARS = config.get('TTS_SEGMENT_MAX_CHARS', 300)  # Longer sentences are cut at clause breaks
+    TTS_SEGMENT_GAP = config.get('TTS_SEGMENT_GAP', 0.25)  # Seconds of silence between joined segments
+    REFERENCE_MAX_DURATION = config.get('REFERENCE_MAX_DURATION', 12)  # Seconds of speech kept in a reference voice
+    REFERENCE_LOUDNESS = config.get('REFERENCE_LOUDNESS', -20)  # RMS level of reference voices in dBFS
+    MAX_VOICE_DURATION = config.get('MAX_VOICE_DURATION', 300)  # Longest accepted voice message, in seconds
+    STT_STREAMING_DURATION = config.get('STT_STREAMING_DURATION', 50)  # Longer voice messages use streaming STT
+    VOICE_VAD = config.get('VOICE_VAD', True)  # Cut silence from voice messages before STT
+    VOICE_MAX_PAUSE = config.get('VOICE_MAX_PAUSE', 0.7)  # Longer pauses in voice messages are shortened to this, in seconds
+    STT_CANDIDATE_LANGUAGES = config.get('STT_CANDIDATE_LANGUAGES', 2)  # Languages tried first for a known user
+    STT_PROFILE_MIN_SAMPLES = config.get('STT_PROFILE_MIN_SAMPLES', 3)  # Detections before candidates are used
+    STT_MIN_CONFIDENCE = config.get('STT_MIN_CONFIDENCE', 0.6)  # Below it, recognition is retried with all languages
+    PROGRESS_MIN_INTERVAL = config.get('PROGRESS_MIN_INTERVAL', 1.0)  # Seconds between status updates in a chat
+    SLOW_REQUEST_SECONDS = config.get('SLOW_REQUEST_SECONDS', 0)  # Log the stage breakdown of slower messages, 0 disables
+    DEDUP_MAX_ENTRIES = config.get('DEDUP_MAX_ENTRIES', 10000)  # Processed updates remembered to drop redeliveries
+    USER_ACCESS_CHECK = config.get('USER_ACCESS_CHECK', False)  # Only answer users listed in data/users.txt
+    PREWARM = config.get('PREWARM', True)  # Initialize the LLM client, tokenizer and STT client in the background at startup
 
 # Set environment variables for LangSmith
 os.environ["LANGSMITH_TRACING"] = "true"
@@ -39,312 +92,629 @@ os.environ["OPENAI_API_KEY"] = config["OPENAI_API_KEY"]
 # Configure Telegram bot API endpoints
 server_api_uri = 'http://localhost:8081/bot{0}/{1}'
 telebot.apihelper.API_URL = server_api_uri
+telebot.asyncio_helper.API_URL = server_api_uri
 server_file_url = 'http://localhost:8081'
 telebot.apihelper.FILE_URL = server_file_url
+telebot.asyncio_helper.FILE_URL = server_file_url
 
 # Initialize bot from config
-with open('config.json') as config_file:
-    config = json.load(config_file)
-    bot = telebot.TeleBot(config['TOKEN'])
-    
-# Initialize OpenAI chat model
-llm = ChatOpenAI(
-    model_name="gpt-4",
-    openai_api_key=config['OPENAI_API_KEY']
+# AsyncTeleBot keeps a pooled aiohttp session to the Bot API server
+bot = AsyncTeleBot(config['TOKEN'])
+
+# OpenAI chat model, created on first use: langchain_openai is slow to import
+LLM_MODEL = "gpt-4"
+llm = None
+llm_lock = threading.Lock()
+
+def get_llm():
+    """Returns the chat model client, creating it on first use. Blocks,
+    so coroutines use ensure_llm() instead."""
+    global llm
+    with llm_lock:
+        if llm is None:
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(
+                model_name=LLM_MODEL,
+                openai_api_key=config['OPENAI_API_KEY'],
+                stream_usage=True
+            )
+        return llm
+
+async def ensure_llm():
+    """Returns the chat model client, creating it in a thread so the event loop isn't blocked."""
+    if llm is not None:
+        return llm
+    return await asyncio.to_thread(get_llm)
+
+# System prompt of users without a mentagram
+DEFAULT_SYSTEM_PROMPT = "Your name is Janet. You are a helpful AI assistant."
+
+# Local tokenizer of the model, to fit prompts into HISTORY_TOKEN_BUDGET
+token_counter = TokenCounter(LLM_MODEL)
+
+# Background summarization of older messages, one task per user
+summary_tasks = {}
+
+# Bounded pool for CPU-bound audio work, so ffmpeg never blocks the event loop
+audio_executor = ThreadPoolExecutor(max_workers=AUDIO_WORKERS, thread_name_prefix='audio')
+
+async def run_audio_task(func, *args, **kwargs):
+    """Runs blocking audio processing in the bounded audio pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(audio_executor, functools.partial(func, *args, **kwargs))
+
+# Cache of synthesized speech, keyed by text, language and reference voice
+tts_cache = TTSCache('data/tts_cache', TTS_CACHE_MAX_BYTES) if TTS_CACHE_MAX_BYTES > 0 else None
+
+def load_reference(filename: str):
+    """Returns the stored reference voice of a "<user_id>.wav" reference, or None."""
+    reference_path = f'data/users/{os.path.splitext(filename)[0]}/reference.wav'
+    if not os.path.exists(reference_path):
+        return None
+    with open(reference_path, 'rb') as f:
+        return f.read()
+
+# Pooled client of the TTS servers
+os.makedirs('data', exist_ok=True)
+tts_client = TTSClient(
+    TTS_API_URLS,
+    timeout=TTS_TIMEOUT,
+    retries=TTS_RETRIES,
+    cache=tts_cache,
+    hedge_percentile=TTS_HEDGE_PERCENTILE,
+    failure_threshold=TTS_BREAKER_FAILURES,
+    cooldown=TTS_BREAKER_COOLDOWN,
+    health_interval=TTS_HEALTH_INTERVAL,
+    reference_loader=load_reference,
+    state_path='data/tts_references.json',
+    batch_window=TTS_BATCH_WINDOW,
+    batch_max_size=TTS_BATCH_MAX_SIZE
+)
+
+# Per-chat budget of status message updates
+progress_limiter = ChatRateLimiter(PROGRESS_MIN_INTERVAL)
+
+# Background processing of incoming messages, in order for each user
+job_queue = UserJobQueue(QUEUE_WORKERS, QUEUE_MAX_DEPTH, QUEUE_OVERFLOW)
+
+# Updates seen recently, so redelivered webhooks aren't answered twice
+deduplicator = UpdateDeduplicator('data/processed_updates.txt', DEDUP_MAX_ENTRIES)
+
+# Seconds each subsystem took to initialize in the background, or its error
+warmup = {}
+warmup_task = None
+prompt_tools_loaded = False
+
+def warm_prompt():
+    """Loads the tokenizer and langchain's message classes by building a prompt. Blocks."""
+    global prompt_tools_loaded
+    compile_prompt({}, DEFAULT_SYSTEM_PROMPT, token_counter).messages([], '', 'en')
+    prompt_tools_loaded = True
+
+async def ensure_prompt_tools() -> None:
+    """Loads what building and counting prompts needs, in a thread the first time."""
+    if not prompt_tools_loaded:
+        await asyncio.to_thread(warm_prompt)
+
+async def prewarm():
+    """Initializes the lazily created subsystems one by one, off the event loop,
+    so the first messages after a restart don't pay for it."""
+    subsystems = [
+        ('tokenizer', token_counter.load),
+        ('prompt', warm_prompt),
+        ('llm', get_llm),
+        ('stt', get_speech_client)
+    ]
+    for name, init in subsystems:
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(init)
+            warmup[name] = {"seconds": round(time.monotonic() - start, 3)}
+        except Exception as e:
+            # Retried on first use
+            logger.warning(f"Pre-warming {name} failed: {e}")
+            warmup[name] = {"error": str(e)}
+    logger.info(f"Pre-warmed: {warmup}")
+
+@app.on_event("startup")
+async def startup():
+    global warmup_task
+    job_queue.start()
+    tts_client.start()
+    if PREWARM:
+        # Not awaited: /test and webhooks are served while it runs
+        warmup_task = asyncio.create_task(prewarm())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await job_queue.stop()
+    await bot.close_session()
+    await tts_client.close()
+    await asyncio.gather(*summary_tasks.values(), return_exceptions=True)
+    audio_executor.shutdown(wait=False)
+
+# Cache of chat history windows and mentagram init data
+user_cache = UserCache(USER_CACHE_MAX_BYTES)
+
+# Mentagram sent by /mentagram if mentagram.json is missing
+DEFAULT_MENTAGRAM = {
+    "system_prompt": "Your name is Janet. You are a helpful AI assistant that specializes in answering questions clearly and accurately.",
+    "chat_history": [
+        ["system", "Remember to be friendly and concise in your responses."],
+        ["user", "What can you help me with?"],
+        ["assistant", "I can help you with information, answering questions, creative writing, language translation, and more. Just let me know what you need!"]
+    ]
+}
+
+# Static files, loaded once and reloaded when they change on disk
+resources = ResourceRegistry()
+resources.register('languages', 'BCP-47.txt', load_languages, default=[])  # Supported speech recognition languages
+resources.register('greeting', 'greeting.txt', read_text)
+resources.register('logo', 'voclone.png', read_bytes)
+resources.register(
+    'mentagram', 'mentagram.json', read_json_bytes,
+    default=json.dumps(DEFAULT_MENTAGRAM, ensure_ascii=False, indent=2).encode('utf-8')
 )
+if USER_ACCESS_CHECK:
+    resources.register('users', 'data/users.txt', read_id_set, default=set())
 
 def user_access(message):
-    with open('data/users.txt') as f:
-        users = f.read().splitlines()
-    return str(message['from']['id']) in users
+    return str(message['from']['id']) in resources.get('users')
 
-def manage_chat_history(user_id: str, message_id: str, text: Union[str, dict], role: str = "user"):
-    """Manages chat history for a user, storing messages and pruning old ones."""
-    # Create user directory if it doesn't exist
-    user_dir = f'data/users/{user_id}'
-    os.makedirs(user_dir, exist_ok=True)
+def get_history_store(user_id: str) -> HistoryStore:
+    """Returns the append-only conversation store of a user."""
+    return HistoryStore(f'data/users/{user_id}')
 
-    # Save current message
-    date = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'{date}_{message_id}.json'
-    
+def manage_chat_history(user_id: str, message_id: str, text: Union[str, dict], role: str = "user"):
+    """Appends a message or a user/assistant exchange to the user's chat history."""
     if isinstance(text, dict):
-        # Store directly in new format
-        message_data = text
+        # Conversation turn in the {"user", "assistant"} format
+        turns = legacy_message_to_turns(text)
     else:
-        # Legacy single message format
-        message_data = {
-            role: text
+        # Single message
+        turns = [(role, text)]
+    get_history_store(user_id).append(turns, message_id=message_id)
+    # Write through to the cached history window
+    user_cache.update(
+        user_id,
+        'history',
+        lambda window: {
+            'end': window['end'] + 1,
+            'records': (window['records'] + [turns])[-HISTORY_WINDOW:]
         }
-    
-    with open(os.path.join(user_dir, filename), 'w', encoding='utf-8') as f:
-        json.dump(message_data, f, ensure_ascii=False)
-
-    # Get all message files and their creation times
-    files = []
-    total_length = 0
-    for f in os.listdir(user_dir):
-        if f.endswith('.json'):
-            filepath = os.path.join(user_dir, f)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = json.load(file)
-                # Calculate length based on the format of the message
-                if 'user' in content and 'assistant' in content:
-                    # New format
-                    total_length += len(content['user']) + len(content['assistant'])
-                elif 'content' in content:
-                    # Old format
-                    if isinstance(content['content'], dict):
-                        total_length += len(content['content']['user_message']) + len(content['content']['assistant_response'])
-                    else:
-                        total_length += len(content['content'])
-                else:
-                    # Single message format
-                    total_length += sum(len(v) for v in content.values())
-
-    # Sort files by creation time (oldest first)
-    files.sort(key=lambda x: x[1])
-
-    # Remove oldest files until total length is below threshold
-    while total_length > HISTORY_THRESHOLD and files:
-        filepath, _, content = files[0]
-        total_length -= len(content['content'])
-        os.remove(filepath)
-        files.pop(0)
-
-def get_chat_history(user_id: str) -> list:
-    """Retrieves chat history for a user as a list of message tuples,
-    including any initialization history."""
-    # First, get any initialization history
-    init_data = get_user_init_data(user_id)
+    )
+
+def get_user_prompt(user_id: str) -> CompiledPrompt:
+    """Returns the compiled prompt prefix of a user, rebuilt only when the mentagram changes."""
+    prompt = user_cache.get(user_id, 'prompt')
+    if prompt is None:
+        prompt = compile_prompt(get_user_init_data(user_id), DEFAULT_SYSTEM_PROMPT, token_counter)
+        user_cache.set(user_id, 'prompt', prompt)
+    return prompt
+
+def get_history_window(user_id: str) -> dict:
+    """Returns the newest conversation records as {'records': [...], 'end': total record count}."""
+    window = user_cache.get(user_id, 'history')
+    if window is None:
+        if os.path.exists(f'data/users/{user_id}'):
+            store = get_history_store(user_id)
+            records = store.read_recent_records(HISTORY_WINDOW)
+            window = {'end': store.count(), 'records': records}
+        else:
+            window = {'end': 0, 'records': []}
+        user_cache.set(user_id, 'history', window)
+    return window
+
+def get_history_summary(user_id: str) -> dict:
+    """Returns the rolling summary of the user's older messages."""
+    summary = user_cache.get(user_id, 'summary')
+    if summary is None:
+        summary = get_history_store(user_id).read_summary()
+        user_cache.set(user_id, 'summary', summary)
+    return summary
+
+def get_chat_history(user_id: str, prompt: CompiledPrompt, question: str) -> list:
+    """Retrieves chat history for a user as a list of message tuples:
+    a summary of older messages and as many of the newest messages as fit
+    into HISTORY_TOKEN_BUDGET next to the prompt prefix and the question."""
     history = []
-    
-    # Add initialization history if it exists
-    if 'chat_history' in init_data and isinstance(init_data['chat_history'], list):
-        for entry in init_data['chat_history']:
-            if isinstance(entry, list) and len(entry) == 2:
-                history.append((entry[0], entry[1]))
-    
-    user_dir = f'data/users/{user_id}'
-    if not os.path.exists(user_dir):
-        return history  # Return just initialization history if no user directory
-
-    # Get all message files and their creation times
-    files = []
-    for f in os.listdir(user_dir):
-        if f.endswith('.json') and f != 'init_config.json':
-            filepath = os.path.join(user_dir, f)
-            files.append((filepath, os.path.getctime(filepath)))
-
-    # Sort files by creation time (oldest first)
-    files.sort(key=lambda x: x[1])
-
-    # Add regular chat history
-    for filepath, _ in files:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            message_data = json.load(f)
-            if 'user' in message_data and 'assistant' in message_data:
-                # Handle new format
-                history.extend([
-                    ("user", message_data['user']),
-                    ("assistant", message_data['assistant'])
-                ])
-            elif isinstance(message_data.get('content'), dict):
-                # Handle old conversation format
-                content = message_data['content']
-                history.extend([
-                    ("user", content['user_message']),
-                    ("assistant", content['assistant_response'])
-                ])
-            else:
-                # Handle legacy single message format
-                history.append((message_data['role'], message_data['content']))
+    summary = get_history_summary(user_id)
+    if summary['text']:
+        history.append(("system", f"Summary of the earlier conversation:\n{summary['text']}"))
+
+    window = get_history_window(user_id)
+    records = window['records']
+    start = window['end'] - len(records)
+    # Skip records already folded into the summary
+    skip = min(max(summary['records'] - start, 0), len(records))
+    records = records[skip:]
+    start += skip
 
+    budget = HISTORY_TOKEN_BUDGET - prompt.fixed_tokens - token_counter.count_messages(
+        [*history, ("human", question)]
+    )
+    first = fit_records(records, budget, token_counter)
+    if start + first > summary['records']:
+        # Older messages no longer fit. Fold them into the summary down to the
+        # low-water mark, so the summary is rewritten every few turns rather than
+        # on every turn, and the prompt stays the same up to the newest messages
+        # in between, for the provider's prompt cache
+        low_water = fit_records(records, int(budget * HISTORY_LOW_WATER), token_counter)
+        schedule_summary(user_id, start + low_water)
+    history.extend(flatten_records(records[first:]))
     return history
 
+def schedule_summary(user_id: str, records: int) -> None:
+    """Starts summarizing records [0, records) in the background, unless already running."""
+    if user_id in summary_tasks:
+        return
+    task = asyncio.create_task(update_history_summary(user_id, records))
+    summary_tasks[user_id] = task
+    task.add_done_callback(lambda _: summary_tasks.pop(user_id, None))
+
+async def update_history_summary(user_id: str, records: int) -> None:
+    """Folds the records not yet summarized, up to records, into the user's summary."""
+    store = get_history_store(user_id)
+    summary = get_history_summary(user_id)
+    try:
+        turns = await asyncio.to_thread(store.read_range, summary['records'], records)
+        await ensure_prompt_tools()
+        text = await summarize(
+            await ensure_llm(), summary['text'], turns, token_counter,
+            max_tokens=HISTORY_SUMMARY_TOKENS, input_tokens=HISTORY_TOKEN_BUDGET
+        )
+    except Exception as e:
+        logger.error(f"History summarization failed for user {user_id}: {e}")
+        return
+    if store.count() < records:
+        # The history was cleared meanwhile
+        return
+    store.write_summary(text, records)
+    user_cache.set(user_id, 'summary', {'text': text, 'records': records})
+    logger.info(f"Summarized {records - summary['records']} records for user {user_id}")
+
 def clear_chat_history(user_id: str) -> None:
     """Clears all chat history for a given user."""
     user_dir = f'data/users/{user_id}'
     if os.path.exists(user_dir):
-        for file in os.listdir(user_dir):
-            # Skip the init_config.json file which contains mentagram configuration
-            if file.endswith('.json') and file != 'init_config.json':
-                os.remove(os.path.join(user_dir, file))
-
-def convert_audio_to_wav(input_path: str) -> str:
-    """
-    Convert audio file to WAV format with 16kHz sample rate, mono channel, and 16-bit depth.
-    Returns path to converted file and temp directory.
-    """
-    # Create unique output directory
-    output_dir = f'data/{str(uuid.uuid4())}'
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Generate output path
-    output_path = os.path.join(output_dir, 'audio.wav')
-    
-    # Convert audio with explicit parameters
-    audio = AudioSegment.from_file(input_path)
-    audio = audio.set_frame_rate(16000)  # Set sample rate to 16kHz
-    audio = audio.set_channels(1)        # Convert to mono
-    audio = audio.set_sample_width(2)    # Set to 16-bit (2 bytes)
-    
-    # Export with explicit parameters
-    audio.export(
-        output_path,
-        format="wav",
-        parameters=["-acodec", "pcm_s16le"]  # Force 16-bit PCM encoding
+        # The mentagram configuration in init_config.json is kept
+        get_history_store(user_id).clear()
+    user_cache.invalidate(user_id, 'history')
+    user_cache.invalidate(user_id, 'summary')
+
+def get_language_profile(user_id: str) -> dict:
+    """Returns the detected language counts of a user."""
+    profile = user_cache.get(user_id, 'languages')
+    if profile is None:
+        profile = load_profile(f'data/users/{user_id}')
+        user_cache.set(user_id, 'languages', profile)
+    return profile
+
+def update_language_profile(user_id: str, language_code: str) -> None:
+    """Counts a detected language in the user's profile."""
+    profile = record_language(get_language_profile(user_id), language_code)
+    save_profile(f'data/users/{user_id}', profile)
+    user_cache.set(user_id, 'languages', profile)
+
+async def transcribe_voice(pcm: bytes, language_codes: list):
+    """Runs STT on a voice message. Speech longer than STT_STREAMING_DURATION
+    is streamed to STT in chunks."""
+    if len(pcm) > STT_STREAMING_DURATION * SAMPLE_RATE * SAMPLE_WIDTH:
+        # Half a second per request, within the streaming request size limit
+        chunk_size = SAMPLE_RATE * SAMPLE_WIDTH // 2
+        chunks = (pcm[i:i + chunk_size] for i in range(0, len(pcm), chunk_size))
+        return await asyncio.to_thread(transcribe_streaming, chunks, language_codes, SAMPLE_RATE)
+    return await asyncio.to_thread(
+        transcribe_multiple_languages, pcm, language_codes, sample_rate_hertz=SAMPLE_RATE
     )
-    
-    return output_path, output_dir
 
-def send_voice_message(chat_id, voice_file_path, reply_to_message_id=None):
+def is_confident(stt_response) -> bool:
+    """True if speech was recognized with enough confidence. Recognizers that
+    don't report confidence (0.0) are trusted."""
+    results = [result for result in stt_response.results if result.alternatives]
+    if not results:
+        return False
+    confidence = results[0].alternatives[0].confidence
+    return confidence == 0.0 or confidence >= STT_MIN_CONFIDENCE
+
+async def recognize_voice(user_id: str, pcm: bytes):
+    """Recognizes a voice message with the user's usual languages first,
+    falling back to every supported language on low confidence."""
+    languages = resources.get('languages')
+    candidates = rank_languages(get_language_profile(user_id), languages, STT_CANDIDATE_LANGUAGES, STT_PROFILE_MIN_SAMPLES)
+    stt_response = await transcribe_voice(pcm, candidates)
+    if candidates != languages and not is_confident(stt_response):
+        logger.info(f"Low STT confidence with {candidates}, retrying with all languages")
+        stt_response = await transcribe_voice(pcm, languages)
+    return stt_response
+
+async def send_voice_message(chat_id, speech: bytes, reply_to_message_id=None, trace: RequestTrace = None):
     """Helper function to send voice messages via Telegram"""
     try:
-        logger.info(f"Sending voice message: {voice_file_path} to {chat_id}")
+        logger.info(f"Sending voice message: {len(speech)} bytes to {chat_id}")
         # Convert WAV to OGG format with OPUS codec
-        audio = AudioSegment.from_wav(voice_file_path)
-        ogg_path = voice_file_path.replace('.wav', '.ogg')
-        audio.export(
-            ogg_path,
-            format="ogg",
-            codec="libopus",  # Ensure we're using OPUS codec
-            parameters=["-strict", "-2"]  # Required for some ffmpeg versions
-        )
-        
-        # Send the OGG file using file object
-        with open(ogg_path, 'rb') as voice_file:
-            logger.info(f"Sending voice message: {ogg_path}")
-            bot.send_voice(
+        with span(trace, 'encode'):
+            voice = await run_audio_task(encode_ogg_opus, speech)
+        with span(trace, 'send'):
+            await bot.send_voice(
                 chat_id,
-                voice_file,  # Send the file object instead of path
+                io.BytesIO(voice),
                 reply_to_message_id=reply_to_message_id
             )
             
-        # Clean up OGG file
-        os.remove(ogg_path)
-            
     except Exception as e:
         logger.error(f"Error sending voice message: {e}")
         if 'VOICE_MESSAGES_FORBIDDEN' in str(e):
-            bot.send_message(
+            await bot.send_message(
                 chat_id,
                 "Sorry, I can't send voice messages. Please enable voice messages for everyone in your Telegram privacy settings (Settings -> Privacy and Security -> Voice Messages).",
                 reply_to_message_id=reply_to_message_id
             )
         raise
 
-def process_llm_response(user_id: str, message_id: str, user_message: str, chat_id: int, reply_to_message_id: int, language: str = 'en') -> None:
-    """Common function to handle LLM processing and response generation"""
+def format_timings(timings: dict) -> str:
+    """Formats stage timings for the progress message, e.g. 'stt 1.2s | llm 3.4s'."""
+    return ' | '.join(f"{stage} {seconds}s" for stage, seconds in timings.items())
+
+async def synthesize_speech(user_id: str, text: str, language: str, trace: RequestTrace = None):
+    """Generates speech with the user's reference voice.
+    Returns the WAV audio, or None if synthesis failed."""
     try:
-        # Language format simplification "en-US" -> "en"
-        language = language.split('-')[0]
-                
-        # Get chat history and create prompt template
-        chat_history = get_chat_history(user_id)
-        
-        # Get initialization data for custom system prompt
-        init_data = get_user_init_data(user_id)
-        system_prompt = init_data.get('system_prompt', 
-            f"Your name is Janet. You are a helpful AI assistant. Please respond in {language} language.")
-        
-        # Create prompt template with history placeholder
-        history_placeholder = MessagesPlaceholder("history")
-        prompt_template = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            history_placeholder,
-            ("human", "{question}")
-        ])
-
-        # Generate prompt with chat history
-        prompt_value = prompt_template.invoke({
-            "history": chat_history,
-            "question": user_message
-        })
+        # Generate speech using the user's reference file
+        with span(trace, 'tts'):
+            speech = await tts_client.generate_speech(
+                text=text,
+                language=language,
+                reference_file=f"{user_id}.wav"
+            )
+        logger.info(f"Generated speech: {len(speech) if speech else None} bytes")
+        return speech
+    except Exception as e:
+        logger.error(f"Error generating voice message: {e}")
+        return None
 
-        # Get response from LLM
-        llm_response = llm.invoke(prompt_value).content
+async def synthesize_answer(user_id: str, text: str, language: str, trace: RequestTrace = None):
+    """Synthesizes the answer sentence by sentence, TTS_SEGMENT_CONCURRENCY
+    segments at a time, and joins the audio in order.
+    Returns the WAV audio, or None if any segment failed."""
+    segments = segment_text(text, language, TTS_SEGMENT_MAX_CHARS)
+    if not segments:
+        return None
+    semaphore = asyncio.Semaphore(TTS_SEGMENT_CONCURRENCY)
 
-        # Store both user message and LLM response
-        manage_chat_history(
-            user_id,
-            str(message_id),
-            {
-                "user": user_message,
-                "assistant": llm_response
-            }
+    async def synthesize(segment):
+        async with semaphore:
+            return await tts_client.generate_speech(
+                text=segment,
+                language=language,
+                reference_file=f"{user_id}.wav"
+            )
+
+    try:
+        with span(trace, 'tts'):
+            speeches = await asyncio.gather(*(synthesize(segment) for segment in segments))
+        if any(speech is None for speech in speeches):
+            return None
+        if len(speeches) == 1:
+            return speeches[0]
+        with span(trace, 'concat'):
+            speech = await run_audio_task(concat_speech, speeches, TTS_SEGMENT_GAP)
+        logger.info(f"Generated speech: {len(speech)} bytes from {len(segments)} segments")
+        return speech
+    except Exception as e:
+        logger.error(f"Error generating voice message: {e}")
+        return None
+
+async def deliver_voice_response(chat_id: int, speech: bytes, text: str, reply_to_message_id: int, trace: RequestTrace = None) -> None:
+    """Sends the synthesized speech, falling back to text if there is none or sending fails."""
+    try:
+        if speech is None:
+            raise RuntimeError("Speech synthesis failed")
+        # Send voice message
+        await send_voice_message(
+            chat_id,
+            speech,
+            reply_to_message_id=reply_to_message_id,
+            trace=trace
+        )
+    except Exception as e:
+        logger.error(f"Error generating or sending voice message: {e}")
+        # Fall back to text message if voice generation fails
+        await bot.send_message(
+            chat_id,
+            text,
+            reply_to_message_id=reply_to_message_id,
+            parse_mode='Markdown'
         )
-        # Replace dots with newlines in the LLM response
-        llm_response = llm_response.replace('.', '\n')
-        # Crop extra spaces and newlines
-        llm_response = llm_response.strip()
 
-        # Generate and send voice response
+def build_prompt(user_id: str, user_message: str, language: str) -> list:
+    """Assembles the LLM prompt messages for a user's message."""
+    # Compiled system prompt and mentagram history
+    prompt = get_user_prompt(user_id)
+
+    # Get the chat history that fits into the token budget
+    chat_history = get_chat_history(user_id, prompt, user_message)
+
+    # The stable prefix goes first, so the provider's prompt cache can hit
+    return prompt.messages(chat_history, user_message, language)
+
+def log_token_usage(user_id: str, usage: dict) -> None:
+    """Logs prompt tokens and how many of them the provider served from its prompt cache."""
+    if not usage:
+        return
+    cached = usage.get('input_token_details', {}).get('cache_read', 0)
+    logger.info(
+        f"LLM tokens for user {user_id}: prompt {usage['input_tokens']} (cached {cached}), "
+        f"completion {usage['output_tokens']}"
+    )
+
+async def stream_voice_response(prompt_value, user_id: str, language: str, chat_id: int, reply_to_message_id: int, trace: RequestTrace, progress=None) -> str:
+    """Streams the LLM answer and synthesizes it sentence by sentence.
+    Each sentence is sent to TTS as soon as it is complete, and the voice
+    messages are delivered in order. Returns the full LLM answer."""
+    start_time = time.time()
+    speech_tasks = asyncio.Queue()
+
+    async def deliver():
         try:
-            # Get TTS server URL from config
-            tts_api_url = config.get('TTS_API_URL', 'http://localhost:5000')
-            logger.info(f"Calling TTS API URL: {tts_api_url}")
-            # Generate speech using the user's reference file
-            speech_file_name = generate_speech(
-                text=llm_response,
-                language=language,
-                reference_file=f"{user_id}.wav",
-                api_url=tts_api_url
-            )
-            logger.info(f"Generated speech file name: {speech_file_name}")
-            # Send voice message
-            send_voice_message(
-                chat_id,
-                speech_file_name,
-                reply_to_message_id=reply_to_message_id
+            while True:
+                item = await speech_tasks.get()
+                if item is None:
+                    break
+                sentence, speech_task = item
+                try:
+                    await deliver_voice_response(chat_id, await speech_task, sentence, reply_to_message_id, trace)
+                except Exception as e:
+                    # The rest of the answer is still delivered
+                    logger.error(f"Delivery of a sentence to chat {chat_id} failed: {e}")
+                    trace.outcome = 'error'
+                    continue
+                if 'first_audio' not in trace.timings:
+                    trace.record('first_audio', time.time() - start_time)
+        finally:
+            # Speech of sentences that won't be delivered
+            while not speech_tasks.empty():
+                item = speech_tasks.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+
+    def dispatch(sentence):
+        speech_tasks.put_nowait((sentence, asyncio.create_task(synthesize_speech(user_id, sentence, language, trace))))
+
+    delivery = asyncio.create_task(deliver())
+    chunks = []
+    buffer = ''
+    dispatched = 0
+    try:
+        with trace.stage('llm'):
+            async for chunk in (await ensure_llm()).astream(prompt_value):
+                if chunk.usage_metadata:
+                    # Sent with the last chunk
+                    log_token_usage(user_id, chunk.usage_metadata)
+                chunks.append(chunk.content)
+                buffer += chunk.content
+                sentences, buffer = split_sentences(buffer, language)
+                for sentence in sentences:
+                    if progress and not dispatched:
+                        progress('synthesis')
+                    dispatch(sentence)
+                    dispatched += 1
+        if buffer.strip():
+            if progress and not dispatched:
+                progress('synthesis')
+            dispatch(buffer.strip())
+    finally:
+        speech_tasks.put_nowait(None)
+        with trace.stage('delivery'):
+            await delivery
+    logger.info(f"Time to first audio: {trace.timings.get('first_audio')} sec., total: {round(time.time() - start_time, 2)} sec.")
+    return ''.join(chunks)
+
+async def process_llm_response(user_id: str, message_id: str, user_message: str, chat_id: int, reply_to_message_id: int, trace: RequestTrace, language: str = 'en', progress=None) -> None:
+    """Conversation pipeline shared by text and voice messages:
+    prompt -> LLM -> history -> TTS -> delivery, each stage run exactly once.
+    Calls progress(stage) before the slow stages, if given; it must not block.
+    Records the stage timings in trace."""
+    trace.language = language
+    try:
+        # Language format simplification "en-US" -> "en"
+        language = language.split('-')[0]
+
+        with trace.stage('prompt'):
+            await ensure_prompt_tools()
+            prompt_value = build_prompt(user_id, user_message, language)
+
+        if progress:
+            progress('thinking')
+        if TTS_STREAMING:
+            # LLM, TTS and delivery overlap sentence by sentence
+            llm_response = await stream_voice_response(
+                prompt_value, user_id, language, chat_id, reply_to_message_id, trace, progress
             )
-            
-            # Clean up
-            os.remove(speech_file_name)
-            
-        except Exception as e:
-            logger.error(f"Error generating or sending voice message: {e}")
-            # Fall back to text message if voice generation fails
-            bot.send_message(
-                chat_id,
-                llm_response,
-                reply_to_message_id=reply_to_message_id,
-                parse_mode='Markdown'
+        else:
+            with trace.stage('llm'):
+                # Get response from LLM
+                response = await (await ensure_llm()).ainvoke(prompt_value)
+                llm_response = response.content
+            log_token_usage(user_id, response.usage_metadata)
+
+        with trace.stage('history'):
+            # Store both user message and LLM response
+            manage_chat_history(
+                user_id,
+                str(message_id),
+                {
+                    "user": user_message,
+                    "assistant": llm_response
+                }
             )
+
+        if not TTS_STREAMING:
+            llm_response = llm_response.strip()
+
+            # Generate and send voice response
+            if progress:
+                progress('synthesis')
+            speech = await synthesize_answer(user_id, llm_response, language, trace)
+            with trace.stage('delivery'):
+                await deliver_voice_response(chat_id, speech, llm_response, reply_to_message_id, trace)
             
     except Exception as e:
         logger.error(f"Error in LLM processing: {e}")
-        bot.send_message(
+        trace.outcome = 'error'
+        await bot.send_message(
             chat_id,
             "Sorry, there was an error processing your message.",
             reply_to_message_id=reply_to_message_id
         )
+    logger.info(f"Pipeline timings for user {user_id}: {format_timings(trace.timings)}")
 
-async def send_reply(bot_token, chat_id, message_id, text):
-    url = f"http://localhost:8081/bot{bot_token}/sendMessage"
+def status_text(text: str, bold: bool = False) -> str:
+    """Formats a progress status for MarkdownV2: monospace, or bold."""
     # Escape dots in text for MarkdownV2 format
     text = text.replace('.', '\\.')
-    payload = {
-        'chat_id': chat_id,
-        'text': f"*{text}*",
-        'reply_to_message_id': message_id,
-        'parse_mode': 'MarkdownV2'
-    }
-    response = requests.post(url, data=payload)
-    logger.info(f"Update message response: {response.json()}")
-    return response.json()
+    return f"*{text}*" if bold else f"`{text}`"
 
 @app.post("/message")
 async def call_message(request: Request, authorization: str = Header(None)):
     message = await request.json()
     logger.info(message)
 
-    # if not user_access(message):
-    #     return JSONResponse(content={
-    #         "type": "text", 
-    #         "body": "You are not authorized to use this bot."
-    #     })
+    if USER_ACCESS_CHECK and not user_access(message):
+        return JSONResponse(content={
+            "type": "text",
+            "body": "You are not authorized to use this bot."
+        })
+
+    # A redelivered update is acknowledged like the original, which sends the only reply
+    key = update_key(message)
+    state = deduplicator.begin(key)
+    if state != 'new':
+        DUPLICATE_UPDATES.labels(state).inc()
+        logger.info(f"Dropped duplicate update {key}, the original is {state.replace('_', ' ')}")
+        return JSONResponse(content={"type": "empty", "body": ''})
+
+    # Acknowledge at once, the reply is sent by a queue worker
+    user_id = str(message['from']['id'])
+    if not job_queue.submit(user_id, functools.partial(handle_update, key, message)):
+        deduplicator.cancel(key)
+        return JSONResponse(content={
+            "type": "text",
+            "body": "Sorry, I'm too busy right now. Please try again in a minute."
+        })
+    return JSONResponse(content={"type": "empty", "body": ''})
 
+async def handle_update(key: str, message: dict, queue_wait: float = 0.0) -> None:
+    """Processes an accepted update and marks it as done."""
+    try:
+        await handle_message(message, queue_wait)
+    finally:
+        deduplicator.finish(key)
+
+async def handle_message(message: dict, queue_wait: float = 0.0) -> None:
+    """Processes a single Telegram update. Runs in a job queue worker."""
     chat_id = message['chat']['id']
     user_id = str(message['from']['id'])
 
@@ -355,7 +725,7 @@ async def call_message(request: Request, authorization: str = Header(None)):
             try:
                 # Get the file from Telegram
                 file_id = message['document']['file_id']
-                file_info = bot.get_file(file_id)
+                file_info = await bot.get_file(file_id)
                 file_path = file_info.file_path
                 
                 # Load and parse the mentagram.json file
@@ -363,65 +733,84 @@ async def call_message(request: Request, authorization: str = Header(None)):
                     init_data = json.load(f)
                 
                 # Save the initialization data
+                await ensure_prompt_tools()
                 save_user_init_data(user_id, init_data)
                 
-                bot.send_message(
+                await bot.send_message(
                     chat_id,
                     "Initialization file successfully processed!",
                     reply_to_message_id=message['message_id']
                 )
             except Exception as e:
                 logger.error(f"Error processing mentagram.json file: {e}")
-                bot.send_message(
+                await bot.send_message(
                     chat_id,
                     "Sorry, there was an error processing the initialization file.",
                     reply_to_message_id=message['message_id']
                 )
-            return JSONResponse(content={"type": "empty", "body": ''})
+            return
         
         # Handle audio documents (existing code)
         elif 'audio' in message['document']['mime_type']:
             try:
                 # Get the file from Telegram
                 file_id = message['document']['file_id']
-                file_info = bot.get_file(file_id)
+                file_info = await bot.get_file(file_id)
                 file_path = file_info.file_path
 
-                # Convert to WAV if needed
-                wav_path, temp_dir = convert_audio_to_wav(file_path)
-                
+                # Trim silence, cap the duration and normalize loudness
+                wav = await run_audio_task(
+                    prepare_reference, file_path, REFERENCE_MAX_DURATION, REFERENCE_LOUDNESS
+                )
+                if not wav:
+                    await bot.send_message(
+                        chat_id,
+                        "No speech found in the audio file.",
+                        reply_to_message_id=message['message_id']
+                    )
+                    return
+                if reference_hash(user_id) == hashlib.sha256(wav).hexdigest():
+                    await bot.send_message(
+                        chat_id,
+                        "This reference audio is already uploaded.",
+                        reply_to_message_id=message['message_id']
+                    )
+                    return
+
                 # Upload to TTS server
-                tts_api_address = config.get('TTS_API_URL', 'http://localhost:5000')
                 filename = f"{user_id}.wav" # One reference for each user
-                response = upload_reference_file(wav_path, api_url=tts_api_address, filename=filename)
-                
-                # Clean up temporary files
-                os.remove(wav_path)
-                os.rmdir(temp_dir)
+                response = await tts_client.upload_reference(wav, filename=filename)
+                save_reference(user_id, wav)
                 
-                bot.send_message(
+                await bot.send_message(
                     chat_id,
                     "Reference audio file successfully uploaded!",
                     reply_to_message_id=message['message_id']
                 )
             except Exception as e:
                 logger.error(f"Error processing audio document: {e}")
-                bot.send_message(
+                await bot.send_message(
                     chat_id,
                     "Sorry, there was an error processing the audio file.",
                     reply_to_message_id=message['message_id']
                 )
-            return JSONResponse(content={"type": "empty", "body": ''})
+            return
 
     # Handle voice message
     if 'voice' in message and 'audio' in message['voice']['mime_type']:
         voice_file_id = message['voice']['file_id']
         duration = message['voice']['duration']
         
-        if duration < 1:
-            response = "Voice message received, but duration is too short < 1 sec."
-        elif duration > 60:
-            response = "Voice message received, but duration is too long: > 60 sec."
+        if duration < 1 or duration > MAX_VOICE_DURATION:
+            if duration < 1:
+                response = "Voice message received, but duration is too short < 1 sec."
+            else:
+                response = f"Voice message received, but duration is too long: > {MAX_VOICE_DURATION} sec."
+            await bot.send_message(
+                chat_id,
+                response,
+                reply_to_message_id=message['message_id']
+            )
         else:
             # Send status message
             # bot.send_message(
@@ -429,244 +818,253 @@ async def call_message(request: Request, authorization: str = Header(None)):
             #     "Converting audio...",
             #     reply_to_message_id=message['message_id']
             # )
-            update_message = await send_reply(config['TOKEN'], chat_id, message['message_id'], "[     ] Reading the reference voice..")
-            update_id = update_message['result']['message_id']
-            # Get the file path using the Telegram API
-            file_info = bot.get_file(voice_file_id)
-            file_path = file_info.file_path
-            # Log file info and path
-            logger.info(f"File info: {file_info}")
-            logger.info(f"File path: {file_path}")
-            # Check if file exists at file_path
-            if not os.path.exists(file_path):
-                logger.error(f"File not found at path: {file_path}")
-                bot.send_message(
-                    chat_id,
-                    "Sorry, there was an error accessing the voice message file.",
-                    reply_to_message_id=message['message_id']
-                )
-                return JSONResponse(content={"type": "empty", "body": ''})
-            
-            # Convert audio to WAV format
+            trace = RequestTrace(user_id, 'voice', audio_duration=duration, slow_seconds=SLOW_REQUEST_SECONDS)
+            trace.record('queue', queue_wait)
             try:
-                start_time = time.time()
-                bot.edit_message_text(
-                    "`[█    ] Voice convertation..`".replace('.', '\\.'),
-                    chat_id=chat_id,
-                    message_id=update_id,
-                    parse_mode='MarkdownV2'
-                )
-                wav_path, temp_dir = convert_audio_to_wav(file_path)
-                logger.info(f"WAV path: {wav_path}")
-                logger.info(f"Temp dir: {temp_dir}")
-                
-                with open("BCP-47.txt", "r") as f:
-                    languages = [line.strip() for line in f if line.strip()]
-                
-                bot.edit_message_text(
-                    "`[██   ] Voice to text transcribation..`".replace('.', '\\.'),
-                    chat_id=chat_id,
-                    message_id=update_id,
-                    parse_mode='MarkdownV2'
-                )
-                stt_response = transcribe_multiple_languages(wav_path, languages)
-                logger.info(f"STT response: {stt_response}")
-                for result in stt_response.results:
-                    detected_language = result.language_code
-                    transcript = result.alternatives[0].transcript
+                # Status message, updated in the background
+                status = ProgressReporter(bot, chat_id, message['message_id'], progress_limiter)
+                status.update(status_text("[     ] Reading the reference voice..", bold=True))
+                # Get the file path using the Telegram API
+                with trace.stage('download'):
+                    file_info = await bot.get_file(voice_file_id)
+                file_path = file_info.file_path
+                # Log file info and path
+                logger.info(f"File info: {file_info}")
+                logger.info(f"File path: {file_path}")
+                # Check if file exists at file_path
+                if not os.path.exists(file_path):
+                    logger.error(f"File not found at path: {file_path}")
+                    trace.outcome = 'error'
+                    await bot.send_message(
+                        chat_id,
+                        "Sorry, there was an error accessing the voice message file.",
+                        reply_to_message_id=message['message_id']
+                    )
+                    return
+            
+                # Convert audio to WAV format
+                try:
+                    start_time = time.time()
+                    with trace.stage('convert'):
+                        status.update(status_text("[█    ] Voice convertation.."))
+                        # Decoded to 16kHz PCM in memory, no intermediate files
+                        pcm = await run_audio_task(convert_audio_to_pcm, file_path)
+                        logger.info(f"PCM size: {len(pcm)} bytes")
+
+                    if VOICE_VAD:
+                        with trace.stage('vad'):
+                            # Only speech is sent to STT, which bills by the second
+                            speech = await run_audio_task(
+                                compact_speech, pcm, SAMPLE_RATE, max_pause_ms=int(VOICE_MAX_PAUSE * 1000)
+                            )
+                        logger.info(f"Speech: {round(len(speech) / (SAMPLE_RATE * SAMPLE_WIDTH), 1)} of {round(len(pcm) / (SAMPLE_RATE * SAMPLE_WIDTH), 1)} sec.")
+                        if not speech:
+                            status.update(status_text("[█████] Only silence, nothing to recognize."))
+                            return
+                        pcm = speech
+
+                    with trace.stage('stt'):
+                        status.update(status_text("[██   ] Voice to text transcribation.."))
+                        stt_response = await recognize_voice(user_id, pcm)
+                        logger.info(f"STT response: {stt_response}")
+
+                    # Join all recognized fragments into a single turn
+                    results = [result for result in stt_response.results if result.alternatives]
+                    if not results:
+                        status.update(status_text("[█████] Nothing recognized."))
+                        return
+                    detected_language = results[0].language_code
+                    update_language_profile(user_id, detected_language)
+                    transcript = ' '.join(result.alternatives[0].transcript.strip() for result in results)
                     logger.info(f"Detected Language: {detected_language}")
                     logger.info(f"Transcript: {transcript}")
-                    
-                    # Get chat history and create prompt template
-                    chat_history = get_chat_history(user_id)
-                    
-                    # Create prompt template with history placeholder
-                    history_placeholder = MessagesPlaceholder("history")
-                    prompt_template = ChatPromptTemplate.from_messages([
-                        ("system", "Your name is Janet. You are a helpful AI assistant."),
-                        history_placeholder,
-                        ("human", "{question}")
-                    ])
-
-                    # Generate prompt with chat history
-                    prompt_value = prompt_template.invoke({
-                        "history": chat_history,
-                        "question": transcript
-                    })
 
                     # Replace Chinese language code for compatibility
                     if detected_language.lower() == "cmn-hans-cn":
                         detected_language = "zh-cn"
-                    
-                    bot.edit_message_text(
-                        f"`[███  ] [{detected_language}] Thinking..`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                    
-                    # Get response from LLM
-                    llm_response = llm.invoke(prompt_value).content
 
-                    # Store both transcribed message and LLM response
-                    manage_chat_history(
-                        user_id,
-                        str(message['message_id']),
-                        {
-                            "user": transcript,
-                            "assistant": llm_response
-                        }
-                    )
+                    progress_messages = {
+                        'thinking': f"[███  ] [{detected_language}] Thinking..",
+                        'synthesis': f"[████ ] [{detected_language}] Voice synthesis.."
+                    }
+                    def progress(stage):
+                        status.update(status_text(progress_messages[stage]))
 
-                    bot.edit_message_text(
-                        f"`[████ ] [{detected_language}] Voice synthesis..`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                    
-                    # Process LLM response
-                    process_llm_response(
+                    # Run the conversation pipeline once for the whole transcript
+                    await process_llm_response(
                         user_id,
                         message['message_id'],
                         transcript,
                         chat_id,
                         message['message_id'],
-                        detected_language
+                        trace,
+                        detected_language,
+                        progress=progress
                     )
+                    if trace.outcome == 'error':
+                        # The user got an error message instead of an answer
+                        status.update(status_text(f"[█████] [{detected_language}] Failed."))
+                        return
                     logger.info(f"Voice response sent to user {user_id}")
-                    bot.edit_message_text(
-                        f"`[█████] [{detected_language}] Done in {round(time.time() - start_time, 1)} sec.`".replace('.', '\\.'),
-                        chat_id=chat_id,
-                        message_id=update_id,
-                        parse_mode='MarkdownV2'
-                    )
-                # Clean up temporary files
-                os.remove(wav_path)
-                os.rmdir(temp_dir)
-                return JSONResponse(content={"type": "empty", "body": ''})
+                    status.update(status_text(
+                        f"[█████] [{detected_language}] Done in {round(time.time() - start_time, 1)} sec. {format_timings(trace.timings)}"
+                    ))
+                    return
                 
-            except Exception as e:
-                logger.error(f"Error processing audio: {e}")
-                response = "Sorry, there was an error processing the voice message."
-                bot.send_message(
-                    chat_id,
-                    response,
-                    reply_to_message_id=message['message_id']
-                )
+                except Exception as e:
+                    logger.error(f"Error processing audio: {e}")
+                    trace.outcome = 'error'
+                    response = "Sorry, there was an error processing the voice message."
+                    await bot.send_message(
+                        chat_id,
+                        response,
+                        reply_to_message_id=message['message_id']
+                    )
+            except Exception:
+                trace.outcome = 'error'
+                raise
+            finally:
+                trace.finish()
 
-        return JSONResponse(content={"type": "empty", "body": ''})
+        return
 
     # Original text message handling
     if 'text' not in message:
-        bot.send_message(
+        await bot.send_message(
             chat_id,
             "Sorry, this message type is not supported yet.",
             reply_to_message_id=message['message_id']
         )
-        return JSONResponse(content={"type": "empty", "body": ''})
+        return
 
     text = message['text']
 
     if text == '/reset':
         clear_chat_history(user_id)
-        bot.send_message(
+        await bot.send_message(
             chat_id,
             "Chat history has been reset.",
             reply_to_message_id=message['message_id']
         )
-        return JSONResponse(content={"type": "empty", "body": ''})
+        return
     
     if text == '/start':
-        try:
-            with open('greeting.txt', 'r') as f:
-                greeting = f.read()
-            with open("BCP-47.txt", "r") as f:
-                languages = [line.strip() for line in f if line.strip()]
-            greeting += f'\nSupported languages: {languages}'
-            greeting += "\n\nUse /mentagram to get your personalization file. You can edit this file and upload it back to customize how I behave and respond to you!"
-            
-            # Send voclone.png with caption
-            try:
-                with open('voclone.png', 'rb') as photo:
-                    bot.send_photo(
-                        chat_id,
-                        photo,
-                        caption=greeting,
-                        reply_to_message_id=message['message_id']
-                    )
-            except FileNotFoundError:
-                # Fall back to text if image not available
-                bot.send_message(
-                    chat_id,
-                    greeting,
-                    reply_to_message_id=message['message_id']
-                )
-            return JSONResponse(content={"type": "empty", "body": ''})
-        except FileNotFoundError:
-            logger.error("greeting.txt not found")
-            bot.send_message(
+        greeting = resources.get('greeting')
+        if greeting is None:
+            await bot.send_message(
                 chat_id,
                 "Welcome! I'm Janet, your AI assistant. You can use /mentagram to customize how I behave!",
                 reply_to_message_id=message['message_id']
             )
-            return JSONResponse(content={"type": "empty", "body": ''})
+            return
+        greeting += f"\nSupported languages: {resources.get('languages')}"
+        greeting += "\n\nUse /mentagram to get your personalization file. You can edit this file and upload it back to customize how I behave and respond to you!"
+
+        # Send voclone.png with caption
+        logo = resources.get('logo')
+        if logo is not None:
+            await bot.send_photo(
+                chat_id,
+                io.BytesIO(logo),
+                caption=greeting,
+                reply_to_message_id=message['message_id']
+            )
+        else:
+            # Fall back to text if image not available
+            await bot.send_message(
+                chat_id,
+                greeting,
+                reply_to_message_id=message['message_id']
+            )
+        return
 
     # Handle the /mind command to provide a sample or current mentagram.json
     if text == '/mentagram':
         # Log the /mentagram command
         logger.info(f"User {user_id} requested mentagram configuration")
         
-        # Always load the default mentagram.json
-        try:
-            with open('mentagram.json', 'r', encoding='utf-8') as f:
-                default_config = json.load(f)
-        except FileNotFoundError:
-            logger.error("mentagram.json not found")
-            default_config = {
-                "system_prompt": "Your name is Janet. You are a helpful AI assistant that specializes in answering questions clearly and accurately.",
-                "chat_history": [
-                    ["system", "Remember to be friendly and concise in your responses."],
-                    ["user", "What can you help me with?"],
-                    ["assistant", "I can help you with information, answering questions, creative writing, language translation, and more. Just let me know what you need!"]
-                ]
-            }
-        
-        # Create temporary file to send to user
-        temp_file_path = f'data/init_{user_id}.json'
-        with open(temp_file_path, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, ensure_ascii=False, indent=2)
-        
-        # Send file to user
-        with open(temp_file_path, 'rb') as f:
-            bot.send_document(
-                chat_id,
-                f,
-                caption="Here's the default mentagram configuration. You can upload this file to reset your personalization settings to default.",
-                reply_to_message_id=message['message_id'],
-                visible_file_name="mentagram.json"
-            )
-        
-        # Clean up temp file
-        os.remove(temp_file_path)
-        return JSONResponse(content={"type": "empty", "body": ''})
+        # Always send the default mentagram.json, serialized once
+        await bot.send_document(
+            chat_id,
+            io.BytesIO(resources.get('mentagram')),
+            caption="Here's the default mentagram configuration. You can upload this file to reset your personalization settings to default.",
+            reply_to_message_id=message['message_id'],
+            visible_file_name="mentagram.json"
+        )
+        return
 
     # Process LLM response
-    process_llm_response(
-        user_id,
-        message['message_id'],
-        text,
-        chat_id,
-        message['message_id'],
-        'en'
-    )
-
-    return JSONResponse(content={"type": "empty", "body": ''})
+    trace = RequestTrace(user_id, 'text', slow_seconds=SLOW_REQUEST_SECONDS)
+    trace.record('queue', queue_wait)
+    try:
+        await process_llm_response(
+            user_id,
+            message['message_id'],
+            text,
+            chat_id,
+            message['message_id'],
+            trace,
+            'en'
+        )
+    except Exception:
+        trace.outcome = 'error'
+        raise
+    finally:
+        trace.finish()
 
 @app.get("/test")
 async def call_test():
     return JSONResponse(content={"status": "ok"})
 
+@app.get("/metrics")
+async def call_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache_stats")
+async def call_cache_stats():
+    return JSONResponse(content=user_cache.stats())
+
+@app.get("/queue_stats")
+async def call_queue_stats():
+    return JSONResponse(content=job_queue.stats())
+
+@app.get("/dedup_stats")
+async def call_dedup_stats():
+    return JSONResponse(content=deduplicator.stats())
+
+@app.get("/resource_stats")
+async def call_resource_stats():
+    return JSONResponse(content=resources.stats())
+
+@app.get("/warmup_stats")
+async def call_warmup_stats():
+    return JSONResponse(content={"enabled": PREWARM, "done": warmup_task is not None and warmup_task.done(), "subsystems": warmup})
+
+@app.get("/tts_cache_stats")
+async def call_tts_cache_stats():
+    return JSONResponse(content=tts_cache.stats() if tts_cache else {})
+
+@app.get("/tts_stats")
+async def call_tts_stats():
+    return JSONResponse(content=tts_client.stats())
+
+def reference_hash(user_id: str):
+    """Returns the content hash of the user's last uploaded reference voice, or None."""
+    reference_path = f'data/users/{user_id}/reference.wav'
+    if not os.path.exists(reference_path):
+        return None
+    with open(reference_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def save_reference(user_id: str, wav: bytes) -> None:
+    """Keeps a copy of the uploaded reference voice in the user's directory."""
+    user_dir = f'data/users/{user_id}'
+    os.makedirs(user_dir, exist_ok=True)
+    tmp_path = os.path.join(user_dir, 'reference.wav.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(wav)
+    os.replace(tmp_path, os.path.join(user_dir, 'reference.wav'))
+
 def save_user_init_data(user_id: str, init_data: dict) -> None:
     """Saves user initialization data from mentagramjson"""
     user_dir = f'data/users/{user_id}'
@@ -676,20 +1074,30 @@ def save_user_init_data(user_id: str, init_data: dict) -> None:
     init_file_path = os.path.join(user_dir, 'init_config.json')
     with open(init_file_path, 'w', encoding='utf-8') as f:
         json.dump(init_data, f, ensure_ascii=False)
+    user_cache.set(user_id, 'init', init_data)
+    # Compile the prompt once, it is reused until the mentagram changes
+    user_cache.set(user_id, 'prompt', compile_prompt(init_data, DEFAULT_SYSTEM_PROMPT, token_counter))
     
     logger.info(f"Initialization data saved for user {user_id}")
 
 def get_user_init_data(user_id: str) -> dict:
     """Retrieves user initialization data if it exists"""
+    init_data = user_cache.get(user_id, 'init')
+    if init_data is not None:
+        return init_data
     init_file_path = f'data/users/{user_id}/init_config.json'
+    init_data = {}
     if os.path.exists(init_file_path):
         with open(init_file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+            init_data = json.load(f)
+    user_cache.set(user_id, 'init', init_data)
+    return init_data
 
 def reset_user_init_data(user_id: str) -> None:
     """Removes the initialization data for a user"""
     init_file_path = f'data/users/{user_id}/init_config.json'
     if os.path.exists(init_file_path):
         os.remove(init_file_path)
+        user_cache.invalidate(user_id, 'init')
+        user_cache.invalidate(user_id, 'prompt')
         logger.info(f"Initialization data reset for user {user_id}")
\ No newline at end of file
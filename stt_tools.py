@@ -1,33 +1,61 @@
-from typing import List
-from google.cloud import speech_v1 as speech
+from typing import Iterable, List, Union
+from types import SimpleNamespace
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 # Set logger level to INFO
 logger.setLevel(logging.INFO)
 
-def transcribe_multiple_languages(audio_file: str, language_codes: List[str]):
+# Long-lived client: the gRPC channel and credentials are set up once
+_client = None
+_client_lock = threading.Lock()
+
+def _speech():
+    """Returns the Speech-to-Text module, imported on first use as it's slow to load."""
+    from google.cloud import speech_v1
+    return speech_v1
+
+def get_speech_client():
+    """Returns the shared Speech-to-Text client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = _speech().SpeechClient()
+        return _client
+
+def recognition_config(language_codes: List[str], sample_rate_hertz: int = None) -> dict:
+    config = {
+        "encoding": _speech().RecognitionConfig.AudioEncoding.LINEAR16,
+        "language_code": language_codes[0],  # Primary language
+        "alternative_language_codes": language_codes[1:],  # Alternative languages
+        "model": "latest_long"  # Use the latest model
+    }
+    if sample_rate_hertz:
+        config["sample_rate_hertz"] = sample_rate_hertz
+    return config
+
+def transcribe_multiple_languages(audio_file: Union[str, bytes], language_codes: List[str], sample_rate_hertz: int = None):
     """Transcribe an audio file using Google Cloud Speech-to-Text API with support for multiple languages.
 
     Args:
-        audio_file (str): Path to the local audio file to be transcribed.
+        audio_file (Union[str, bytes]): Path to the local audio file, or the LINEAR16 audio itself.
         language_codes (List[str]): A list of BCP-47 language codes for transcription.
+        sample_rate_hertz (int): Sample rate, required for headerless PCM audio.
 
     Returns:
-        None: Prints the transcription results.
+        RecognizeResponse: The transcription results.
     """
-    client = speech.SpeechClient()
+    client = get_speech_client()
 
-    # Reads a file as bytes
-    with open(audio_file, "rb") as f:
-        audio_content = f.read()
+    if isinstance(audio_file, bytes):
+        audio_content = audio_file
+    else:
+        # Reads a file as bytes
+        with open(audio_file, "rb") as f:
+            audio_content = f.read()
 
-    config = {
-        "encoding": speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        "language_code": language_codes[0],  # Primary language
-        "alternative_language_codes": language_codes[1:],  # Alternative languages
-        "model": "latest_long"  # Use the latest model
-    }
+    config = recognition_config(language_codes, sample_rate_hertz)
 
     audio = {"content": audio_content}
     logger.info(f"STT Config: {config}")
@@ -35,6 +63,32 @@ def transcribe_multiple_languages(audio_file: str, language_codes: List[str]):
 
     return response
 
+def transcribe_streaming(audio_chunks: Iterable[bytes], language_codes: List[str], sample_rate_hertz: int):
+    """Transcribe audio with streaming recognition, sending it in chunks.
+    Unlike transcribe_multiple_languages, this isn't limited to 60 seconds of audio.
+
+    Args:
+        audio_chunks (Iterable[bytes]): LINEAR16 audio chunks, e.g. slices of decoded PCM.
+        language_codes (List[str]): A list of BCP-47 language codes for transcription.
+        sample_rate_hertz (int): Sample rate of the audio.
+
+    Returns:
+        An object with the final results in .results, like RecognizeResponse.
+    """
+    client = get_speech_client()
+    config = recognition_config(language_codes, sample_rate_hertz)
+    logger.info(f"STT streaming config: {config}")
+    speech = _speech()
+    streaming_config = speech.StreamingRecognitionConfig(config=config)
+    requests = (speech.StreamingRecognizeRequest(audio_content=chunk) for chunk in audio_chunks)
+    results = []
+    for response in client.streaming_recognize(config=streaming_config, requests=requests):
+        for result in response.results:
+            if result.is_final:
+                logger.info(f"STT final result: {result.alternatives[0].transcript if result.alternatives else ''}")
+                results.append(result)
+    return SimpleNamespace(results=results)
+
 # Example usage
 if __name__ == "__main__":
     audio_file_path = "in.wav"  # Replace with your audio file path
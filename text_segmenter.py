@@ -0,0 +1,124 @@
+import re
+from typing import List, Tuple
+
+# Words that end with a dot without ending the sentence, lowercase and
+# without the final dot, by language
+ABBREVIATIONS = {
+    'en': {'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'vs', 'etc', 'e.g', 'i.e', 'approx',
+           'inc', 'ltd', 'co', 'fig', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct',
+           'nov', 'dec', 'a.m', 'p.m', 'u.s', 'u.k'},
+    'ru': {'т.е', 'т.д', 'т.п', 'т.к', 'т.н', 'др', 'пр', 'г', 'гг', 'в', 'вв', 'ул', 'д', 'кв', 'стр', 'им',
+           'проф', 'акад', 'см', 'млн', 'млрд', 'тыс', 'руб', 'коп', 'напр', 'рис', 'табл'},
+    'uk': {'т.д', 'т.п', 'т.б', 'др', 'г', 'р', 'ст', 'вул', 'буд', 'кв', 'проф', 'див', 'млн', 'млрд', 'тис',
+           'грн', 'напр'},
+    'de': {'z.b', 'd.h', 'u.a', 'usw', 'bzw', 'ca', 'dr', 'prof', 'nr', 'str', 'vgl', 'evtl', 'ggf', 'inkl',
+           'hr', 'fr', 'mio', 'mrd', 'bspw', 'sog'},
+    'fr': {'m', 'mm', 'mme', 'mlle', 'dr', 'pr', 'etc', 'cf', 'env', 'p.ex', 'av', 'bd', 'st', 'ste'},
+    'es': {'sr', 'sra', 'srta', 'dr', 'dra', 'ud', 'uds', 'etc', 'p.ej', 'aprox', 'av', 'núm', 'pág'},
+    'it': {'sig', 'sig.ra', 'dott', 'prof', 'ecc', 'es', 'pag', 'ing', 'avv', 'geom'},
+    'pt': {'sr', 'sra', 'dr', 'dra', 'etc', 'ex', 'pág', 'av', 'núm', 'prof'},
+}
+
+# Abbreviations that are also common words, only taken as abbreviations
+# before a number: "No. 5" but "No. We stay home."
+NUMBER_ABBREVIATIONS = {
+    'en': {'no'},
+}
+
+# Languages writing ordinal numbers with a dot: "am 3. Oktober"
+ORDINAL_DOT_LANGUAGES = {'de', 'da', 'nb', 'no', 'fi', 'cs', 'sk', 'pl', 'hu', 'hr', 'sl', 'tr'}
+
+# A candidate sentence end: terminal punctuation with closing quotes or
+# brackets, followed by whitespace; CJK terminal punctuation; a line break
+BOUNDARY = re.compile(r'[.!?…]+["»”’)\]]*(?=\s)|[。！？]+["」』”）]*|\n+')
+CLAUSE_BREAK = re.compile(r'[,;:—–]\s')
+
+
+def _is_sentence_end(text: str, start: int, match: re.Match, language: str) -> bool:
+    """Decides whether a '.' boundary ends the sentence started at start."""
+    punct = match.group().rstrip('"»”’)]')
+    if punct != '.':
+        # '!', '?', '...' and combinations always end a sentence
+        return True
+    before = text[start:match.start()]
+    word = before.split()[-1].lstrip('"«“‘([') if before.split() else ''
+    next_char = text[match.end():].lstrip()[:1]
+    if next_char.islower():
+        # "Dr. smith", "3. Oktober", "e.g. this"
+        return False
+    if word.lower() in ABBREVIATIONS.get(language, ()):
+        return False
+    if word.lower() in NUMBER_ABBREVIATIONS.get(language, ()) and next_char.isdigit():
+        return False
+    if len(word) == 1 and word.isupper():
+        # Initials: "J. R. R. Tolkien"
+        return False
+    if word.isdigit() and (before.strip() == word or language in ORDINAL_DOT_LANGUAGES):
+        # Numbered list item "1. First", or an ordinal number
+        return False
+    return True
+
+
+def split_sentences(text: str, language: str = 'en') -> Tuple[List[str], str]:
+    """Splits text into complete sentences and the unfinished remainder.
+
+    A sentence is complete once the text that follows its end is known, so
+    streamed text can be split as it arrives: the remainder is carried over
+    to the next call. Decimal numbers, abbreviations of the language,
+    initials and list numbers don't end a sentence.
+    """
+    language = (language or 'en').split('-')[0].lower()
+    sentences = []
+    start = 0
+    for match in BOUNDARY.finditer(text):
+        if match.group().startswith('\n') or match.group()[0] in '。！？':
+            end = match.end()
+        else:
+            if not text[match.end():].strip():
+                # Whether the sentence ends depends on the next word
+                break
+            if not _is_sentence_end(text, start, match, language):
+                continue
+            end = match.end()
+        sentence = text[start:end].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = end
+    return sentences, text[start:]
+
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    """Cuts a sentence longer than max_chars at clause breaks, or else at spaces."""
+    parts = []
+    while len(sentence) > max_chars:
+        window = sentence[:max_chars]
+        breaks = [m.end() for m in CLAUSE_BREAK.finditer(window)]
+        cut = breaks[-1] if breaks else window.rfind(' ') + 1
+        if cut <= 0:
+            cut = max_chars
+        parts.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        parts.append(sentence)
+    return parts
+
+
+def segment_text(text: str, language: str = 'en', max_chars: int = 300, min_chars: int = 40) -> List[str]:
+    """Splits a complete text into segments to synthesize separately.
+
+    Every sentence becomes a segment. Sentences longer than max_chars are
+    cut at clause breaks, and ones shorter than min_chars are joined with
+    a neighbour, so a segment isn't too short to be spoken naturally.
+    """
+    sentences, remainder = split_sentences(text, language)
+    if remainder.strip():
+        sentences.append(remainder.strip())
+    pieces = [piece for sentence in sentences for piece in _split_long(sentence, max_chars)]
+    segments = []
+    for piece in pieces:
+        if segments and (len(segments[-1]) < min_chars or len(piece) < min_chars) \
+                and len(segments[-1]) + 1 + len(piece) <= max_chars:
+            segments[-1] = f"{segments[-1]} {piece}"
+        else:
+            segments.append(piece)
+    return segments
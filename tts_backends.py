@@ -0,0 +1,132 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import List
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+# Samples of recent request latencies kept per backend
+LATENCY_WINDOW = 200
+# Latency assumed for a backend without samples, in seconds
+DEFAULT_LATENCY = 1.0
+
+
+class TTSBackend:
+    """State of one TTS server: load, latency and a circuit breaker.
+
+    The breaker opens after failure_threshold consecutive failures and
+    keeps the backend out of rotation for cooldown seconds. After that a
+    single trial request is let through: success closes the breaker,
+    failure opens it again. A successful health check closes it at once.
+    """
+
+    def __init__(self, url: str, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.latency_ewma = None
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.requests = 0
+        self.errors = 0
+        # Reference file name -> content hash known to be on this server
+        self.references = {}
+        self.reference_locks = {}
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def available(self) -> bool:
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.trial)
+
+    def latency(self) -> float:
+        return self.latency_ewma if self.latency_ewma is not None else DEFAULT_LATENCY
+
+    def score(self) -> float:
+        """Expected wait on this backend: its latency times the queue ahead."""
+        return self.latency() * (self.in_flight + 1)
+
+    def percentile(self, q: float, min_samples: int = 20):
+        """Returns the q-th percentile of recent latencies, or None with too few samples."""
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+    def start(self) -> None:
+        self.in_flight += 1
+        self.requests += 1
+        if self.state == 'half-open':
+            self.trial = True
+
+    def succeeded(self, seconds: float = None) -> None:
+        """Counts a successful request, with its latency if it is a synthesis."""
+        self.in_flight -= 1
+        if seconds is not None:
+            self.latencies.append(seconds)
+            self.latency_ewma = seconds if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * seconds
+        self.close()
+
+    def failed(self) -> None:
+        self.in_flight -= 1
+        self.mark_down()
+
+    def mark_down(self) -> None:
+        """Counts a failed request or health check."""
+        self.errors += 1
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial:
+                logger.warning(f"TTS backend {self.url} ejected after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+    def cancelled(self) -> None:
+        """A request abandoned by the caller, e.g. the loser of a hedged pair."""
+        self.in_flight -= 1
+        self.trial = False
+
+    def close(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"TTS backend {self.url} is back in rotation")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def reference_lock(self, filename: str) -> asyncio.Lock:
+        if filename not in self.reference_locks:
+            self.reference_locks[filename] = asyncio.Lock()
+        return self.reference_locks[filename]
+
+    def stats(self) -> dict:
+        p95 = self.percentile(95, min_samples=1)
+        return {
+            "url": self.url,
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ewma": round(self.latency(), 3),
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "references": len(self.references)
+        }
+
+
+def choose_backend(backends: List[TTSBackend], exclude=()) -> TTSBackend:
+    """Returns the available backend with the lowest expected wait, or None."""
+    candidates = [backend for backend in backends if backend.available() and backend not in exclude]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda backend: backend.score())
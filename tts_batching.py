@@ -0,0 +1,86 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+
+class TTSBatcher:
+    """Collects concurrent synthesis requests into batches.
+
+    A batch is sent window seconds after its first request arrives, or at
+    once when it reaches max_size requests. send(items, expires) makes the
+    batch call and returns one result per item, the WAV audio or an
+    exception; every caller gets back its own result. Several batches can
+    be in flight at the same time.
+    """
+
+    def __init__(self, send, window: float = 0.02, max_size: int = 8):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.pending = []  # (item, expires, future) of the batch being collected
+        self.timer = None
+        self.tasks = set()
+        # Counters
+        self.batches = 0
+        self.items = 0
+        self.wait_total = 0.0
+        self.first_arrival = None
+
+    async def submit(self, item: dict, expires: float) -> bytes:
+        """Adds a request to the next batch and returns its audio. Raises the error of its item."""
+        future = asyncio.get_running_loop().create_future()
+        if not self.pending:
+            self.first_arrival = time.monotonic()
+            self.timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        self.pending.append((item, expires, future))
+        if len(self.pending) >= self.max_size:
+            self._flush()
+        return await future
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.wait_total += time.monotonic() - self.first_arrival
+        task = asyncio.create_task(self._send_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send_batch(self, batch: list) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        items = [item for item, expires, future in batch]
+        # The batch has to meet the earliest deadline among its requests
+        expires = min(expires for item, expires, future in batch)
+        try:
+            results = await self.send(items, expires)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (item, _, future), result in zip(batch, results):
+            if future.done():
+                # The caller gave up
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self) -> None:
+        """Sends the batch being collected and waits for the batches in flight."""
+        self._flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        n = self.batches or 1
+        return {
+            "batches": self.batches,
+            "batch_avg_size": round(self.items / n, 2),
+            "batch_avg_wait": round(self.wait_total / n, 4)
+        }
@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import tempfile
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+REFERENCES_FILE = 'references.json'
+
+
+class TTSCache:
+    """Content-addressed cache of synthesized speech on disk.
+
+    Entries are keyed by hash(text, language, reference content hash), so a
+    new reference voice never serves stale audio. The total size of the
+    cached files is bounded by max_bytes, evicting least recently used
+    entries first. Entry file names start with the reference hash, which
+    lets all entries of a replaced reference be purged at once.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.references_path = os.path.join(directory, REFERENCES_FILE)
+        self.references = {}  # reference file name -> content hash
+        if os.path.exists(self.references_path):
+            with open(self.references_path, 'r', encoding='utf-8') as f:
+                self.references = json.load(f)
+        # Restore the LRU order from modification times, touched on every hit
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith('.wav'):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def key(self, text: str, language: str, reference_file: str):
+        """Returns the cache key, or None if the reference content is unknown."""
+        reference_hash = self.references.get(reference_file)
+        if reference_hash is None:
+            return None
+        digest = hashlib.sha256(json.dumps([text, language, reference_hash]).encode('utf-8')).hexdigest()
+        return f"{reference_hash[:16]}_{digest}.wav"
+
+    def get(self, key: str):
+        """Returns the path of the cached audio, or None on a miss."""
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return None
+        path = os.path.join(self.directory, key)
+        os.utime(path)
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return path
+
+    def _add(self, key: str, size: int) -> None:
+        self.total_bytes += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        self._evict()
+
+    def writer(self, key: str) -> 'CacheWriter':
+        """Returns a writer that streams an entry to disk; it is added on commit()."""
+        return CacheWriter(self, key)
+
+    def set_reference(self, reference_file: str, reference_hash: str) -> None:
+        """Records the content hash of an uploaded reference, purging the
+        audio synthesized with the previous one."""
+        old_hash = self.references.get(reference_file)
+        if old_hash == reference_hash:
+            return
+        if old_hash is not None and old_hash not in [
+            h for name, h in self.references.items() if name != reference_file
+        ]:
+            prefix = old_hash[:16] + '_'
+            for name in [name for name in self.entries if name.startswith(prefix)]:
+                self._remove(name)
+        self.references[reference_file] = reference_hash
+        with open(self.references_path, 'w', encoding='utf-8') as f:
+            json.dump(self.references, f)
+        logger.info(f"Reference {reference_file} changed, cache invalidated")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def _remove(self, name: str) -> None:
+        self.total_bytes -= self.entries.pop(name)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+
+
+class CacheWriter:
+    """Streams a cache entry into a temporary file, so a failed or
+    oversized download never becomes a visible entry.
+
+    Every writer has its own temporary file, so concurrent syntheses of the
+    same text don't mix; the last one to commit wins. Disk errors are
+    logged and only skip caching, they never fail the synthesis.
+    """
+
+    def __init__(self, cache: TTSCache, key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self.file = None
+        self.tmp_path = None
+        try:
+            fd, self.tmp_path = tempfile.mkstemp(prefix=key + '.', suffix='.tmp', dir=cache.directory)
+            self.file = os.fdopen(fd, 'wb')
+        except OSError as e:
+            logger.warning(f"Can't cache {key}: {e}")
+
+    def write(self, chunk: bytes) -> None:
+        if self.file is None:
+            return
+        try:
+            self.file.write(chunk)
+            self.size += len(chunk)
+        except OSError as e:
+            logger.warning(f"Can't cache {self.key}: {e}")
+            self.discard()
+
+    def commit(self) -> None:
+        if self.file is None:
+            return
+        if self.size > self.cache.max_bytes:
+            self.discard()
+            return
+        try:
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp_path, os.path.join(self.cache.directory, self.key))
+        except OSError as e:
+            logger.warning(f"Can't cache {self.key}: {e}")
+            self.discard()
+            return
+        self.cache._add(self.key, self.size)
+
+    def discard(self) -> None:
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        if self.tmp_path is not None:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+            self.tmp_path = None
@@ -1,85 +1,503 @@
-import requests
+import aiohttp
+import asyncio
+import io
 import os
 import time
-import uuid
+import json
+import base64
+import random
+import hashlib
 import logging
+from types import SimpleNamespace
+from tts_backends import TTSBackend, choose_backend
+from tts_batching import TTSBatcher
 
 logger = logging.getLogger(__name__)
 # Set logger level to INFO
 logger.setLevel(logging.INFO)
 
-def generate_speech(text, language, reference_file='asmr_0.wav', api_url="http://localhost:5000"):
-    # Request payload
-    payload = {
-        'text': text,
-        'language': language,
-        'reference_file': reference_file
-    }
-    
-    try:
-        # Send POST request
-        response = requests.post(f"{api_url}/tts", json=payload)
-        logger.info(f"TTS response: {response}")
-        # Check if request was successful
-        if response.status_code == 200:
-            # Create data directory if it doesn't exist
-            os.makedirs('data', exist_ok=True)
-            
-            # Generate unique filename using UUID
-            unique_id = str(uuid.uuid4())
-            output_filename = f'data/speech_{unique_id}.wav'
-            
-            # Save the audio file
-            with open(output_filename, 'wb') as f:
-                f.write(response.content)
-            print(f"Audio saved as {output_filename}")
-            return output_filename
-        else:
-            print(f"Error: {response.json().get('error', 'Unknown error')}")
-            return None
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Connection error: {str(e)}")
-        return None
+CHUNK_SIZE = 64 * 1024
+# Set on error pages ngrok serves for a tunnel, e.g. when its agent is offline
+NGROK_ERROR_HEADER = 'ngrok-error-code'
 
-def upload_reference_file(file_path, api_url="http://localhost:5000", filename="reference.wav"):
-    """
-    Upload a reference audio file to the TTS server
-    
-    Args:
-        file_path (str): Path to the audio file
-        api_url (str): Base URL of the API server
-    
-    Returns:
-        dict: Server response
+
+class TTSError(Exception):
+    """Raised when the TTS server can't be reached or rejects a request."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _is_down(response) -> bool:
+    """True for replies meaning the TTS server itself is down: 5xx, or an ngrok error page."""
+    return response.status >= 500 or NGROK_ERROR_HEADER in response.headers
+
+
+def _trace_config():
+    """Records connection setup and response header times of each request."""
+    async def on_request_start(session, ctx, params):
+        ctx.trace_request_ctx.start = time.monotonic()
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.trace_request_ctx.connect_start = time.monotonic()
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.trace_request_ctx.connect = time.monotonic() - ctx.trace_request_ctx.connect_start
+
+    async def on_request_end(session, ctx, params):
+        ctx.trace_request_ctx.headers = time.monotonic()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+class TTSClient:
+    """Client of a pool of TTS servers.
+
+    Keeps a persistent connection pool, so calls skip the TCP+TLS handshake
+    to the tunnel, bounds every call by a deadline, retries connection
+    errors with jittered exponential backoff and streams synthesized audio
+    to its destination as it arrives.
+
+    api_url is one server URL or a list of them. Each request goes to the
+    healthy server with the lowest expected wait; failing servers are
+    ejected by a circuit breaker, and retries move to another server. With
+    hedge_percentile set, a request still running after that percentile of
+    its server's latency is also sent to a second server, and the first
+    answer wins. Reference voices are uploaded to every server, and synced
+    lazily to servers that missed an upload: reference_loader(filename)
+    returns the reference audio, or None if it isn't managed by the client.
+
+    With batch_window set, concurrent syntheses are collected for up to
+    batch_window seconds, or batch_max_size texts, and sent together to the
+    server's /tts_batch endpoint.
     """
-    # Check if file exists
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-    
-    # Prepare the file and filename for upload
-    files = {
-        'file': open(file_path, 'rb')
-    }
-    
-    data = {
-        'filename': filename
-    }
-    
-    try:
-        response = requests.post(
-            f"{api_url}/upload_reference",
-            files=files,
-            data=data
+
+    def __init__(self, api_url="http://localhost:5000", pool_size=100, timeout=60.0,
+                 connect_timeout=10.0, retries=3, backoff=0.5, cache=None, hedge_percentile=0,
+                 failure_threshold=3, cooldown=30.0, health_interval=0, health_path='/',
+                 reference_loader=None, state_path=None, batch_window=0, batch_max_size=8):
+        urls = [api_url] if isinstance(api_url, str) else list(api_url)
+        self.backends = [TTSBackend(url, failure_threshold, cooldown) for url in urls]
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.hedge_percentile = hedge_percentile
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.reference_loader = reference_loader
+        self.reference_hashes = {}  # reference file name -> content hash of the current reference
+        self.state_path = state_path
+        self.batcher = TTSBatcher(self._send_batch, batch_window, batch_max_size) if batch_window > 0 else None
+        self.session = None
+        self.health_task = None
+        # Latency totals, in seconds
+        self.requests = 0
+        self.connect_total = 0.0
+        self.server_total = 0.0
+        self.transfer_total = 0.0
+        self.hedges = 0
+        self.reference_syncs = 0
+        self._load_state()
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                trace_configs=[_trace_config()]
+            )
+        return self.session
+
+    def start(self) -> None:
+        """Starts the periodic health checks, if enabled. Needs a running event loop."""
+        if self.health_interval and self.health_task is None:
+            self.health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self) -> None:
+        if self.batcher is not None:
+            await self.batcher.close()
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _send(self, backend, path, expires, sink=None, json=None, form=None, measure=True):
+        """Makes a single POST attempt of json, or the multipart form built
+        by form(), to one backend. The response body is written to sink in
+        chunks, or returned parsed as JSON if there is no sink. With measure,
+        the request counts towards the backend's latency.
+        Returns (result, latency)."""
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise TTSError(f"Deadline exceeded: {path}")
+        ctx = SimpleNamespace(start=time.monotonic(), connect=0.0, headers=None)
+        timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=min(self.connect_timeout, remaining))
+        backend.start()
+        # Whatever happens, the request leaves the backend's in_flight count
+        outcome = 'failed'
+        try:
+            async with self._session().post(
+                f"{backend.url}{path}",
+                json=json,
+                data=form() if form else None,
+                timeout=timeout,
+                trace_request_ctx=ctx
+            ) as response:
+                headers_time = ctx.headers or time.monotonic()
+                if response.status != 200:
+                    body = await response.text()
+                    message = f"TTS server error {response.status}: {body[:200]}"
+                    if _is_down(response):
+                        # A dead server behind the tunnel, another backend can serve the request
+                        raise TTSError(message, retryable=True)
+                    # The server is up and rejected this request, e.g. an unknown
+                    # reference; that doesn't count towards ejecting it
+                    outcome = 'rejected'
+                    raise TTSError(message)
+                if sink is None:
+                    try:
+                        result = await response.json()
+                    except ValueError as e:
+                        raise TTSError(f"Invalid TTS server reply: {e}") from e
+                else:
+                    result = 0
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        sink(chunk)
+                        result += len(chunk)
+                latency = {
+                    'connect': round(ctx.connect, 3),
+                    'server': round(headers_time - ctx.start - ctx.connect, 3),
+                    'transfer': round(time.monotonic() - headers_time, 3)
+                }
+            outcome = 'succeeded'
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Connection errors, truncated bodies and malformed replies.
+            # Only failures before the response started are safe to retry
+            raise TTSError(f"{type(e).__name__}: {e}", retryable=ctx.headers is None) from e
+        finally:
+            if outcome == 'succeeded':
+                backend.succeeded(time.monotonic() - ctx.start if measure else None)
+            elif outcome == 'rejected':
+                backend.succeeded()
+            elif outcome == 'cancelled':
+                backend.cancelled()
+            else:
+                backend.failed()
+        return result, latency
+
+    async def _request(self, path, expires, sink=None, json=None, form=None, reference_files=(), backend=None,
+                       tried=None):
+        """Sends a request to the best available backend, or first to the
+        given one, retrying connection errors and down servers on other backends until the
+        deadline. The backend gets the reference_files first, if it lacks
+        them. Every backend used is appended to tried.
+        Returns (result, latency)."""
+        tried = [] if tried is None else tried
+        attempt = 0
+        while True:
+            if backend is None:
+                # Prefer a backend that hasn't failed this request yet
+                backend = choose_backend(self.backends, exclude=tried) or choose_backend(self.backends)
+            if backend is None:
+                raise TTSError("No TTS server available")
+            tried.append(backend)
+            try:
+                for reference_file in reference_files:
+                    await self._sync_reference(backend, reference_file, expires)
+                return await self._send(backend, path, expires, sink=sink, json=json, form=form)
+            except TTSError as e:
+                if not e.retryable or attempt >= self.retries:
+                    raise
+                delay = min(random.uniform(0, self.backoff * 2 ** attempt), max(expires - time.monotonic(), 0))
+                attempt += 1
+                logger.warning(f"TTS request to {backend.url} failed ({e}), retry {attempt} in {round(delay, 2)} sec.")
+                backend = None
+                await asyncio.sleep(delay)
+
+    async def _hedged_request(self, path, expires, json=None, reference_file=None):
+        """Sends a request to the best backend and, if it is slower than its
+        hedge_percentile latency, to a second one. Returns the first
+        successful (audio, latency)."""
+        async def attempt(backend, tried):
+            buffer = io.BytesIO()
+            size, latency = await self._request(
+                path, expires, sink=buffer.write, json=json, reference_files=[reference_file], backend=backend, tried=tried
+            )
+            return buffer.getvalue(), latency
+
+        # The first attempt picks its backend when it starts, the likely pick sets the hedge delay
+        likely = choose_backend(self.backends)
+        hedge_after = likely.percentile(self.hedge_percentile) if likely else None
+        tried = []
+        tasks = {asyncio.create_task(attempt(None, tried))}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                second = choose_backend(self.backends, exclude=tried) if not done else None
+                if second is not None:
+                    self.hedges += 1
+                    logger.info(f"TTS request on {tried[-1].url} exceeded {round(hedge_after, 2)} sec., hedging to {second.url}")
+                    tasks.add(asyncio.create_task(attempt(second, [])))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _sync_reference(self, backend, reference_file, expires) -> None:
+        """Uploads the reference voice to the backend, unless it already has the current one."""
+        if self.reference_loader is None or reference_file is None:
+            return
+        current = self.reference_hashes.get(reference_file)
+        if current is not None and backend.references.get(reference_file) == current:
+            return
+        # Requests waiting for the sync count as load of the backend
+        backend.in_flight += 1
+        try:
+            async with backend.reference_lock(reference_file):
+                if backend.state == 'open':
+                    # Ejected while this request waited for the sync
+                    raise TTSError(f"TTS server {backend.url} is down", retryable=True)
+                await self._upload_missing_reference(backend, reference_file, expires)
+        finally:
+            backend.in_flight -= 1
+
+    async def _upload_missing_reference(self, backend, reference_file, expires) -> None:
+        """Uploads the reference voice unless the backend already has it. Called under its lock."""
+        content = self.reference_loader(reference_file)
+        if content is None:
+            return
+        current = hashlib.sha256(content).hexdigest()
+        self.reference_hashes.setdefault(reference_file, current)
+        if backend.references.get(reference_file) == current:
+            return
+        logger.info(f"Syncing reference {reference_file} to {backend.url}")
+        await self._send(backend, '/upload_reference', expires, form=self._reference_form(content, reference_file),
+                         measure=False)
+        backend.references[reference_file] = current
+        self.reference_syncs += 1
+        self._save_state()
+
+    @staticmethod
+    def _reference_form(content, filename):
+        def form():
+            # A fresh form for every attempt, aiohttp can't resend one
+            data = aiohttp.FormData()
+            data.add_field('file', content, filename=filename)
+            data.add_field('filename', filename)
+            return data
+        return form
+
+    def _load_state(self) -> None:
+        """Restores which references each backend has, so they aren't uploaded again after a restart."""
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        for backend in self.backends:
+            backend.references = state.get(backend.url, {})
+
+    def _save_state(self) -> None:
+        if self.state_path is None:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({backend.url: backend.references for backend in self.backends}, f)
+        os.replace(tmp_path, self.state_path)
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            # Healthy backends show that with every request; only ejected ones are
+            # probed, so the checks cost nothing against a tunnel's request quota
+            ejected = [backend for backend in self.backends if backend.state != 'closed']
+            await asyncio.gather(*(self._check_health(backend) for backend in ejected), return_exceptions=True)
+
+    async def _check_health(self, backend) -> None:
+        """An HTTP response from the server itself means it is up. 5xx
+        responses and ngrok error pages (a tunnel whose agent is offline
+        still answers) mean it is down."""
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.connect_timeout)
+            ctx = SimpleNamespace(start=time.monotonic(), connect=0.0, headers=None)
+            async with self._session().get(f"{backend.url}{self.health_path}", timeout=timeout,
+                                           trace_request_ctx=ctx) as response:
+                await response.read()
+                if _is_down(response):
+                    error = response.headers.get(NGROK_ERROR_HEADER)
+                    raise TTSError(f"HTTP {response.status}" + (f", ngrok error {error}" if error else ""))
+        except (aiohttp.ClientError, asyncio.TimeoutError, TTSError) as e:
+            logger.warning(f"TTS health check of {backend.url} failed: {e}")
+            backend.mark_down()
+            return
+        if backend.state != 'closed':
+            backend.close()
+
+    def _record(self, latency):
+        self.requests += 1
+        self.connect_total += latency['connect']
+        self.server_total += latency['server']
+        self.transfer_total += latency['transfer']
+
+    async def _send_batch(self, items, expires) -> list:
+        """Synthesizes a batch of payloads in one /tts_batch call. Returns the
+        WAV audio, or a TTSError, of every item."""
+        reference_files = sorted({item['reference_file'] for item in items})
+        response, latency = await self._request('/tts_batch', expires, json={'items': items},
+                                                reference_files=reference_files)
+        results = response.get('results', [])
+        if len(results) != len(items):
+            raise TTSError(f"TTS batch of {len(items)} returned {len(results)} results")
+        self._record(latency)
+        logger.info(f"TTS batch of {len(items)}, connect {latency['connect']}s, server {latency['server']}s, transfer {latency['transfer']}s")
+        return [
+            base64.b64decode(result['audio']) if 'audio' in result
+            else TTSError(f"TTS server error: {result.get('error')}")
+            for result in results
+        ]
+
+    async def synthesize(self, text, language, reference_file, dest, deadline=None) -> None:
+        """Synthesizes text with the reference voice, writing the WAV audio to dest
+        as it is received. Raises TTSError on failure."""
+        # Serve previously synthesized audio for the same text and reference voice
+        cache_key = self.cache.key(text, language, reference_file) if self.cache else None
+        cached_path = self.cache.get(cache_key) if self.cache else None
+        if cached_path:
+            logger.info(f"TTS cache hit: {cache_key}")
+            with open(cached_path, 'rb') as f:
+                dest.write(f.read())
+            return
+
+        # Request payload
+        payload = {
+            'text': text,
+            'language': language,
+            'reference_file': reference_file
+        }
+        expires = time.monotonic() + (deadline or self.timeout)
+        cache_file = self.cache.writer(cache_key) if cache_key else None
+
+        def sink(chunk):
+            dest.write(chunk)
+            if cache_file:
+                cache_file.write(chunk)
+
+        try:
+            if self.batcher is not None:
+                # Latency is recorded per batch
+                audio = await self.batcher.submit(payload, expires)
+                sink(audio)
+                latency = None
+            elif self.hedge_percentile and len(self.backends) > 1:
+                # Hedged attempts are buffered, only the winner reaches dest
+                audio, latency = await self._hedged_request('/tts', expires, json=payload, reference_file=reference_file)
+                sink(audio)
+                size = len(audio)
+            else:
+                size, latency = await self._request('/tts', expires, sink=sink, json=payload,
+                                                    reference_files=[reference_file])
+        except Exception:
+            if cache_file:
+                cache_file.discard()
+            raise
+        if cache_file:
+            cache_file.commit()
+        if latency is not None:
+            self._record(latency)
+            logger.info(f"TTS {size} bytes, connect {latency['connect']}s, server {latency['server']}s, transfer {latency['transfer']}s")
+
+    async def generate_speech(self, text, language, reference_file='asmr_0.wav', deadline=None):
+        """Synthesizes text with the reference voice. Returns the WAV audio, or None on error."""
+        buffer = io.BytesIO()
+        try:
+            await self.synthesize(text, language, reference_file, buffer, deadline=deadline)
+        except TTSError as e:
+            logger.error(f"TTS failed: {e}")
+            return None
+        return buffer.getvalue()
+
+    async def upload_reference(self, audio, filename="reference.wav", deadline=None):
+        """
+        Upload a reference audio file to every available TTS server
+
+        Args:
+            audio (Union[str, bytes]): Path to the audio file, or the WAV audio itself
+            filename (str): Reference file name on the TTS server
+            deadline (float): Seconds to complete the upload, including retries
+
+        Returns:
+            dict: Response of the first server that accepted the upload
+        """
+        if isinstance(audio, bytes):
+            file_content = audio
+        else:
+            # Check if file exists
+            if not os.path.exists(audio):
+                raise FileNotFoundError(f"File not found: {audio}")
+            with open(audio, 'rb') as f:
+                file_content = f.read()
+
+        expires = time.monotonic() + (deadline or self.timeout)
+        reference_hash = hashlib.sha256(file_content).hexdigest()
+        form = self._reference_form(file_content, filename)
+        backends = [backend for backend in self.backends if backend.available()]
+        if not backends:
+            raise TTSError("No TTS server available")
+        responses = await asyncio.gather(
+            *(self._send(backend, '/upload_reference', expires, form=form, measure=False) for backend in backends),
+            return_exceptions=True
         )
-        response.raise_for_status()
-        return response.json()
-    
-    except requests.exceptions.RequestException as e:
-        print(f"Error uploading file: {str(e)}")
-        raise
-    finally:
-        files['file'].close()
+        result = None
+        for backend, response in zip(backends, responses):
+            if isinstance(response, Exception):
+                # Synced before this backend's next request for the reference
+                logger.warning(f"Reference upload to {backend.url} failed: {response}")
+                continue
+            backend.references[filename] = reference_hash
+            if result is None:
+                result = response[0]
+        if result is None:
+            raise TTSError(f"Reference upload failed on every TTS server: {responses[0]}")
+        self.reference_hashes[filename] = reference_hash
+        self._save_state()
+        if self.cache:
+            self.cache.set_reference(filename, reference_hash)
+        return result
+
+    def stats(self) -> dict:
+        n = self.requests or 1
+        stats = {
+            "requests": self.requests,
+            "connect_avg": round(self.connect_total / n, 3),
+            "server_avg": round(self.server_total / n, 3),
+            "transfer_avg": round(self.transfer_total / n, 3),
+            "hedges": self.hedges,
+            "reference_syncs": self.reference_syncs,
+            "backends": [backend.stats() for backend in self.backends]
+        }
+        if self.batcher is not None:
+            stats.update(self.batcher.stats())
+        return stats
+
 
 if __name__ == "__main__":
     url = 'https://d676-5-178-149-227.ngrok-free.app'
@@ -88,4 +506,10 @@ if __name__ == "__main__":
     language = 'ru'
     reference_file = 'kompot.wav'
     # Generate speech
-    generate_speech(url, text, language, reference_file)
+    async def main():
+        client = TTSClient(url)
+        with open('speech.wav', 'wb') as f:
+            await client.synthesize(text, language, reference_file, f)
+        await client.close()
+        print("Audio saved as speech.wav")
+    asyncio.run(main())
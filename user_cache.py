@@ -0,0 +1,109 @@
+import sys
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+
+def estimate_size(value) -> int:
+    """Rough in-memory size of a parsed JSON-like value, in bytes."""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class UserCache:
+    """Bounded LRU cache of per-user data, keyed by user_id.
+
+    Every user entry holds named fields (e.g. the chat history window and
+    the mentagram init data). Whole entries are evicted, least recently
+    used first, once the estimated size of all entries exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # user_id -> {field: value}
+        self.sizes = {}  # user_id -> estimated entry size
+        self.total_bytes = 0
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id: str, field: str):
+        """Returns the cached value, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or field not in entry:
+                self.misses[field] = self.misses.get(field, 0) + 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits[field] = self.hits.get(field, 0) + 1
+            return entry[field]
+
+    def set(self, user_id: str, field: str, value) -> None:
+        with self.lock:
+            entry = self.entries.setdefault(user_id, {})
+            entry[field] = value
+            self.entries.move_to_end(user_id)
+            self._resize(user_id)
+            self._evict()
+
+    def update(self, user_id: str, field: str, func) -> None:
+        """Replaces a cached value with func(value). Does nothing on a miss,
+        so write-through updates never create partial entries."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or field not in entry:
+                return
+            entry[field] = func(entry[field])
+            self._resize(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: str, field: str = None) -> None:
+        """Drops one field of a user entry, or the whole entry."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return
+            if field is None:
+                entry.clear()
+            else:
+                entry.pop(field, None)
+            if entry:
+                self._resize(user_id)
+            else:
+                self._drop(user_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "users": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "evictions": self.evictions
+            }
+
+    def _resize(self, user_id: str) -> None:
+        size = estimate_size(self.entries[user_id])
+        self.total_bytes += size - self.sizes.get(user_id, 0)
+        self.sizes[user_id] = size
+
+    def _drop(self, user_id: str) -> None:
+        del self.entries[user_id]
+        self.total_bytes -= self.sizes.pop(user_id)
+
+    def _evict(self) -> None:
+        # Keep the most recent entry even if it alone exceeds the cap
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            user_id = next(iter(self.entries))
+            self._drop(user_id)
+            self.evictions += 1
+            logger.info(f"Evicted user {user_id} from cache")
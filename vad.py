@@ -0,0 +1,133 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+# Set logger level to INFO
+logger.setLevel(logging.INFO)
+
+FRAME_MS = 30
+# Frames this far above the noise floor count as speech
+SPEECH_MARGIN_DB = 12.0
+# Quieter frames are always silence, whatever the noise floor
+SILENCE_FLOOR_DB = -50.0
+# Frames within this range of the loudest one are always speech
+SPEECH_RANGE_DB = 25.0
+FULL_SCALE = 32768.0
+
+
+def to_samples(pcm: bytes) -> np.ndarray:
+    """Reads 16-bit little-endian mono PCM as float samples in [-1, 1)."""
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) / FULL_SCALE
+
+
+def from_samples(samples: np.ndarray) -> bytes:
+    return (np.clip(samples, -1.0, 1.0 - 1.0 / FULL_SCALE) * FULL_SCALE).astype('<i2').tobytes()
+
+
+def frame_energies(samples: np.ndarray, sample_rate: int, frame_ms: int = FRAME_MS) -> np.ndarray:
+    """Returns the RMS level of every frame, in dBFS."""
+    frame_size = sample_rate * frame_ms // 1000
+    frames = len(samples) // frame_size
+    if frames == 0:
+        return np.empty(0)
+    framed = samples[:frames * frame_size].reshape(frames, frame_size)
+    rms = np.sqrt(np.mean(framed ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def speech_frames(samples: np.ndarray, sample_rate: int, frame_ms: int = FRAME_MS) -> np.ndarray:
+    """Marks the frames that contain speech.
+
+    The threshold adapts to the recording: SPEECH_MARGIN_DB above the noise
+    floor, estimated as the 10th percentile of frame levels, but no higher
+    than SPEECH_RANGE_DB below the loudest frame. A recording that never
+    rises SPEECH_MARGIN_DB above its floor is steady noise or silence.
+    """
+    energies = frame_energies(samples, sample_rate, frame_ms)
+    if len(energies) == 0:
+        return np.zeros(0, dtype=bool)
+    floor = np.percentile(energies, 10)
+    loudest = np.max(energies)
+    if loudest < floor + SPEECH_MARGIN_DB:
+        return np.zeros(len(energies), dtype=bool)
+    threshold = max(min(floor + SPEECH_MARGIN_DB, loudest - SPEECH_RANGE_DB), SILENCE_FLOOR_DB)
+    return energies > threshold
+
+
+def speech_bounds(samples: np.ndarray, sample_rate: int, padding_ms: int = 200, frame_ms: int = FRAME_MS):
+    """Returns the (start, end) sample range from the first to the last
+    speech frame, padded on both sides, or None if there is no speech."""
+    speech = np.flatnonzero(speech_frames(samples, sample_rate, frame_ms))
+    if len(speech) == 0:
+        return None
+    frame_size = sample_rate * frame_ms // 1000
+    padding = sample_rate * padding_ms // 1000
+    start = max(speech[0] * frame_size - padding, 0)
+    end = min((speech[-1] + 1) * frame_size + padding, len(samples))
+    return start, end
+
+
+def trim_silence(pcm: bytes, sample_rate: int, padding_ms: int = 200) -> bytes:
+    """Cuts leading and trailing silence from 16-bit mono PCM. Returns
+    empty bytes if there is no speech at all."""
+    samples = to_samples(pcm)
+    bounds = speech_bounds(samples, sample_rate, padding_ms)
+    if bounds is None:
+        return b''
+    start, end = bounds
+    return pcm[start * 2:end * 2]
+
+
+def compact_speech(pcm: bytes, sample_rate: int, padding_ms: int = 200, max_pause_ms: int = 700,
+                   frame_ms: int = FRAME_MS) -> bytes:
+    """Cuts leading and trailing silence from 16-bit mono PCM and shortens
+    pauses longer than max_pause_ms to that length, keeping padding_ms
+    around speech.
+
+    Returns empty bytes if the recording is silent, below SILENCE_FLOOR_DB
+    throughout, and the PCM unchanged if speech can't be told apart from
+    the background, e.g. in steady noise.
+    """
+    samples = to_samples(pcm)
+    energies = frame_energies(samples, sample_rate, frame_ms)
+    if len(energies) == 0 or np.max(energies) < SILENCE_FLOOR_DB:
+        return b''
+    speech = speech_frames(samples, sample_rate, frame_ms)
+    if not speech.any():
+        return pcm
+
+    # Frames within padding of speech are kept
+    padding = padding_ms // frame_ms
+    keep = np.convolve(speech, np.ones(2 * padding + 1), mode='same') > 0
+
+    # Runs of silent frames: edges are cut, long pauses keep max_pause frames
+    edges = np.diff(np.concatenate(([1], keep.astype(np.int8), [1])))
+    starts, ends = np.flatnonzero(edges == -1), np.flatnonzero(edges == 1)
+    max_pause = max_pause_ms // frame_ms
+    for start, end in zip(starts, ends):
+        if start > 0 and end < len(keep):
+            if end - start <= max_pause:
+                keep[start:end] = True
+            else:
+                # Half of the pause stays on each side
+                keep[start:start + max_pause // 2] = True
+                keep[end - (max_pause - max_pause // 2):end] = True
+
+    frame_size = sample_rate * frame_ms // 1000
+    mask = np.repeat(keep, frame_size)
+    # The samples after the last whole frame go with it
+    mask = np.concatenate((mask, np.full(len(samples) - len(mask), keep[-1])))
+    return np.frombuffer(pcm, dtype='<i2')[mask].tobytes()
+
+
+def normalize_loudness(pcm: bytes, target_db: float = -20.0) -> bytes:
+    """Scales 16-bit mono PCM to the target RMS level in dBFS, without clipping peaks."""
+    samples = to_samples(pcm)
+    if len(samples) == 0:
+        return pcm
+    rms = np.sqrt(np.mean(samples ** 2))
+    peak = np.max(np.abs(samples))
+    if rms <= 0 or peak <= 0:
+        return pcm
+    gain = min(10 ** (target_db / 20) / rms, 0.99 / peak)
+    return from_samples(samples * gain)